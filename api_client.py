@@ -27,6 +27,12 @@ custom_theme = Theme({
 })
 console = Console(highlight=False, theme=custom_theme)
 
+# Seconds the server may hold each status request open while waiting for a change.
+LONG_POLL_WAIT = 25
+
+# Task states after which the status no longer changes (Celery's READY_STATES).
+READY_STATES = ("SUCCESS", "FAILURE", "REVOKED")
+
 def ping_server(session: requests.Session, api_url: str) -> bool:
     """Pings the server to ensure it is available, using a session."""
     with console.status(f"Pinging server at {api_url}...", spinner="dots"):
@@ -142,13 +148,17 @@ def generate_and_wait(session: requests.Session, api_url: str, payload: dict, ti
             task_progress = progress.add_task("Waiting...", total=100)
 
             while True:
-                # Use session.get and add a timeout
-                status_response = session.get(f"{api_url}/tasks/{task_id}", timeout=5)
+                # Long-poll: the server holds the request until the status changes (or LONG_POLL_WAIT passes).
+                status_response = session.get(
+                    f"{api_url}/tasks/{task_id}",
+                    params={"wait": LONG_POLL_WAIT},
+                    timeout=LONG_POLL_WAIT + 10,
+                )
                 status_response.raise_for_status()
                 result_data = status_response.json()
                 status = result_data.get("status")
 
-                if status == "SUCCESS" or status == "FAILURE":
+                if status in READY_STATES:
                     final_result_data = result_data
                     progress.update(task_progress, completed=100, description="[bold white]Finished[/bold white]")
                     break
@@ -160,14 +170,11 @@ def generate_and_wait(session: requests.Session, api_url: str, payload: dict, ti
 
                 elif status == "PENDING":
                     progress.update(task_progress, description="In queue")
-                
-                time.sleep(1)
         
         if final_result_data:
             total_elapsed_time = time.time() - total_start_time
-            is_success = final_result_data.get("status") == "SUCCESS"
-            status_tag = "[OK]" if is_success else "[FAIL]"
-            console.print(f"{status_tag} Task finished in {total_elapsed_time:.2f} seconds.")
+            status_tag = {"SUCCESS": "[OK]", "REVOKED": "[CANCELLED]"}.get(final_result_data.get("status"), "[FAIL]")
+            console.print(f"{status_tag} Task finished with status {final_result_data.get('status')} in {total_elapsed_time:.2f} seconds.")
             return final_result_data
     
     except requests.exceptions.Timeout:
@@ -1,10 +1,14 @@
 # api_client_minimal.py (Fault-tolerant version with Session)
 
+import json
 import requests
 import time
 import sys
 from urllib.parse import urljoin, urlparse
 
+# Task states after which the status no longer changes (Celery's READY_STATES).
+READY_STATES = ("SUCCESS", "FAILURE", "REVOKED")
+
 def ping_server(session: requests.Session, api_url: str) -> bool:
     """Checks if the server is available, using a session."""
     print(f"Pinging {api_url}...")
@@ -48,40 +52,42 @@ def generate_and_wait_minimal(session: requests.Session, api_url: str, payload:
         print(f"Task submitted with ID: {task_id}")
 
         last_percent = -1
-        while True:
-            # Use session.get and add a timeout
-            status_response = session.get(f"{api_url}/tasks/{task_id}", timeout=5)
-            status_response.raise_for_status()
-            result_data = status_response.json()
-            
-            status = result_data.get("status")
-
-            if status == "SUCCESS" or status == "FAILURE":
-                total_elapsed_time = time.time() - total_start_time
-                sys.stdout.write("\r" + " " * 80 + "\r")
-                sys.stdout.flush()
-                
-                print(f"Task finished in {total_elapsed_time:.2f} seconds.")
-                return result_data
-
-            elif status == "PROGRESS":
-                progress_info = result_data.get("progress", {})
-                percent = progress_info.get("percent", 0)
-                
-                if int(percent) != int(last_percent):
-                    bar_length = 40
-                    filled_length = int(bar_length * percent / 100)
-                    bar = '█' * filled_length + '-' * (bar_length - filled_length)
-                    
-                    sys.stdout.write(f"\rProgress: [{bar}] {percent:.0f}%")
+        # The server pushes every status change as a Server-Sent Event, so there is no polling.
+        with session.get(f"{api_url}/tasks/{task_id}/events", stream=True, timeout=(5, 60)) as events:
+            events.raise_for_status()
+            for line in events.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data: "):
+                    continue
+                result_data = json.loads(line[len("data: "):])
+
+                status = result_data.get("status")
+
+                if status in READY_STATES:
+                    total_elapsed_time = time.time() - total_start_time
+                    sys.stdout.write("\r" + " " * 80 + "\r")
+                    sys.stdout.flush()
+
+                    print(f"Task finished with status {status} in {total_elapsed_time:.2f} seconds.")
+                    return result_data
+
+                elif status == "PROGRESS":
+                    progress_info = result_data.get("progress", {})
+                    percent = progress_info.get("percent", 0)
+
+                    if int(percent) != int(last_percent):
+                        bar_length = 40
+                        filled_length = int(bar_length * percent / 100)
+                        bar = '█' * filled_length + '-' * (bar_length - filled_length)
+
+                        sys.stdout.write(f"\rProgress: [{bar}] {percent:.0f}%")
+                        sys.stdout.flush()
+                        last_percent = percent
+
+                elif status == "PENDING":
+                    sys.stdout.write("\rTask is waiting in queue...")
                     sys.stdout.flush()
-                    last_percent = percent
 
-            elif status == "PENDING":
-                sys.stdout.write("\rTask is waiting in queue...")
-                sys.stdout.flush()
-            
-            time.sleep(1)
+        print("\nError: The event stream ended before the task finished.")
 
     except requests.exceptions.Timeout:
         print("\nError: The request timed out. The server might be busy or unresponsive.")
@@ -120,9 +126,8 @@ if __name__ == "__main__":
             # The server provides the full download URL in the response.
             download_url = result['result']['download_url']
             print(f"Download URL: {download_url}")
-
         elif result:
-            print(f"Failure Details: {result.get('result', 'No details')}")
+            print(f"{result.get('status')} Details: {result.get('result', 'No details')}")
         else:
             print("Task execution failed or was interrupted.")
 
@@ -0,0 +1,95 @@
+# bench_startup.py
+
+"""
+Measures how quickly the API tier starts.
+
+  * import: time to import `src.api` in a fresh interpreter, and whether that
+    pulled in ComfyUI or worker code (it must not).
+  * boot:   time from launching `python -m src.main` until GET /ping answers.
+
+Run from the project root:  python bench_startup.py [--runs 5] [--skip-boot]
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent
+
+# Modules the API process must never import.
+FORBIDDEN_MODULES = ("folder_paths", "comfy", "torch", "src.worker", "src.comfy_client")
+
+IMPORT_PROBE = f"""
+import json, sys, time
+start = time.perf_counter()
+import src.api
+elapsed = time.perf_counter() - start
+forbidden = sorted(name for name in sys.modules if any(name == m or name.startswith(m + ".") for m in {FORBIDDEN_MODULES!r}))
+print(json.dumps({{"seconds": elapsed, "modules": len(sys.modules), "forbidden": forbidden}}))
+"""
+
+def measure_import() -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_PROBE],
+        cwd=PROJECT_ROOT, check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def measure_boot(timeout: float = 60) -> float:
+    port = free_port()
+    env = dict(os.environ, UVICORN_HOST="127.0.0.1", UVICORN_PORT=str(port))
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "src.main"],
+        cwd=PROJECT_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f"Server exited with code {server.returncode} before answering /ping.")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/ping", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.02)
+        raise TimeoutError(f"Server did not answer /ping within {timeout} seconds.")
+    finally:
+        server.terminate()
+        server.wait()
+
+def summarize(label: str, samples: list):
+    print(f"{label:<8} median {statistics.median(samples) * 1000:8.1f} ms   min {min(samples) * 1000:8.1f} ms   max {max(samples) * 1000:8.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark API import and boot latency.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--skip-boot", action="store_true", help="Only measure the import (no Redis needed).")
+    args = parser.parse_args()
+
+    imports = [measure_import() for _ in range(args.runs)]
+    summarize("import", [run["seconds"] for run in imports])
+    print(f"         {imports[-1]['modules']} modules loaded")
+
+    forbidden = imports[-1]["forbidden"]
+    if forbidden:
+        print(f"FAIL: importing src.api loaded {', '.join(forbidden)}")
+        sys.exit(1)
+
+    if not args.skip_boot:
+        summarize("boot", [measure_boot() for _ in range(args.runs)])
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,393 @@
 # src/api.py
 
+import asyncio
+import json
 import logging
 import os
-from typing import Any, Dict, Optional, List
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, Optional, List, Tuple
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
-from pydantic import BaseModel, HttpUrl
+from celery import group, states
+from fastapi import FastAPI, Header, HTTPException, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, RedirectResponse, StreamingResponse
+from pydantic import BaseModel, Field, HttpUrl
 from fastapi.concurrency import run_in_threadpool
+from starlette.status import WS_1008_POLICY_VIOLATION
 
-from .celery_app import celery_app
+from . import estimates, idempotency, metrics, result_cache
+from .cancellation import request_cancel
+from .throughput import AdmissionRejected, check_admission, completion_rate, queue_depths
+from .capabilities import capability_registry
+from .celery_app import GENERATE_TASK_NAME, celery_app
 from .config import app_config
-from .manifest_loader import validate_request, load_manifests
-from .worker import generate_task
+from .manifest_loader import validate_request, load_manifests, uses_random_seed
+from .result_storage import media_type, storage_for
+from .routing import choose_queue
+from .scheduling import choose_lane
+from .tenants import Tenant, UnknownTenant, assign_priority, claim_slots, release_slots, tenant_registry
+from .task_store import fetch_task_meta, fetch_task_metas, task_exists, load_batch, save_batch, task_events, watch_task
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="ComfyUI Production Service")
+# Seconds between keep-alive messages on idle event streams.
+EVENT_STREAM_KEEPALIVE = 15
+
+# Maximum number of task IDs accepted by POST /tasks/status.
+MAX_BULK_TASK_IDS = 1000
+
+# Maximum number of requests accepted by POST /generate/batch.
+MAX_BATCH_SIZE = 5000
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    background_refresher = None
+    if app_config.MODEL_DISCOVERY == "registry":
+        try:
+            await capability_registry.refresh()
+            logger.info(f"{len(capability_registry.workers)} live workers report {len(app_config.AVAILABLE_MODELS)} models and {len(app_config.AVAILABLE_LORAS)} LoRAs.")
+        except Exception as e:
+            logger.warning(f"Could not read the worker capability registry at startup: {e}")
+        background_refresher = asyncio.create_task(capability_registry.run())
+    elif app_config.MODEL_INDEX_REFRESH_INTERVAL > 0:
+        background_refresher = asyncio.create_task(refresh_model_index())
+    yield
+    if background_refresher is not None:
+        background_refresher.cancel()
+    await task_events.close()
+
+async def refresh_model_index():
+    """Picks up model and LoRA files added or removed on disk, without a restart."""
+    while True:
+        await asyncio.sleep(app_config.MODEL_INDEX_REFRESH_INTERVAL)
+        try:
+            if await asyncio.to_thread(app_config.refresh_models):
+                logger.info(f"Model index changed: {len(app_config.AVAILABLE_MODELS)} models and {len(app_config.AVAILABLE_LORAS)} LoRAs available.")
+        except Exception as e:
+            logger.warning(f"Could not refresh the model index: {e}")
+
+app = FastAPI(title="ComfyUI Production Service", lifespan=lifespan)
 
 @app.get("/ping")
 async def ping():
     """A simple endpoint to check if the server is alive and responsive."""
     return {"message": "pong"}
 
+@app.get("/metrics")
+async def get_metrics() -> Dict[str, int]:
+    """Returns the counters recorded by the workers (e.g. how often the /history fallback is used)."""
+    return await run_in_threadpool(metrics.read_all)
+
 class GenerationRequest(BaseModel):
     workflow_id: str
     params: Dict[str, Any] = {}
     callback_url: Optional[HttpUrl] = None
+    # The result is useless after this time: the request is rejected if it cannot finish
+    # in time, and the task is discarded if it is still queued when the deadline passes.
+    deadline: Optional[datetime] = None
+
+def request_deadline(request_data: GenerationRequest) -> Optional[datetime]:
+    """Returns the request's deadline as an aware UTC datetime (naive ones are taken as UTC)."""
+    deadline = request_data.deadline
+    if deadline is None:
+        return None
+    if deadline.tzinfo is None:
+        deadline = deadline.replace(tzinfo=timezone.utc)
+    if deadline <= datetime.now(timezone.utc):
+        raise ValueError("The deadline has already passed.")
+    return deadline
+
+async def admit(new_tasks: int, deadline: Optional[datetime]):
+    """Applies admission control, turning a rejection into a 503 with Retry-After."""
+    try:
+        await check_admission(new_tasks, deadline)
+    except AdmissionRejected as e:
+        logger.warning(f"Admission rejected for {new_tasks} task(s): {e}")
+        await run_in_threadpool(metrics.incr, "admission_rejected", new_tasks)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+def identify_tenant(api_key: Optional[str]) -> Optional[Tenant]:
+    """The tenant calling the API (None if no tenants are configured); 401 for a missing or unknown key."""
+    try:
+        return tenant_registry.identify(api_key)
+    except UnknownTenant as e:
+        raise HTTPException(status_code=401, detail=str(e))
+
+async def authorize_task(task_id: str, api_key: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    With tenants configured, only the tenant that created a task may see or cancel it;
+    other callers get 404, as if the task did not exist. Returns the task's stored route.
+    """
+    tenant = identify_tenant(api_key)
+    route = await estimates.load_route(task_id)
+    if tenant is not None and (route is None or route.get("tenant") != tenant.name):
+        raise HTTPException(status_code=404, detail="Task not found.")
+    return route
+
+async def owned_task_ids(task_ids: List[str], api_key: Optional[str]) -> List[bool]:
+    """For each task, whether the caller may see it (always, without tenants)."""
+    tenant = identify_tenant(api_key)
+    if tenant is None:
+        return [True] * len(task_ids)
+    routes = await estimates.load_routes(task_ids)
+    return [route is not None and route.get("tenant") == tenant.name for route in routes]
+
+async def admit_tenant(tenant: Optional[Tenant], task_ids: List[str]) -> Optional[int]:
+    """
+    Claims the tenant's concurrency slots for new tasks, turning a rejection into a 429
+    with Retry-After, and returns the priority to send them with.
+    """
+    if tenant is None:
+        return None
+    priority = await assign_priority(tenant)
+    try:
+        await claim_slots(tenant, task_ids)
+    except AdmissionRejected as e:
+        logger.warning(f"Tenant '{tenant.name}' rejected for {len(task_ids)} task(s): {e}")
+        await run_in_threadpool(metrics.incr, "tenant_limit_rejected", len(task_ids))
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    return priority
+
+def request_cache_key(request_data: GenerationRequest, validated_params: Dict[str, Any]) -> Optional[str]:
+    """
+    Returns the result cache key for a request, or None if its output is not reproducible
+    or its model file cannot be identified (so a replaced file could not be told apart).
+    """
+    if not app_config.RESULT_CACHE_ENABLED or uses_random_seed(request_data.params):
+        return None
+    model = validated_params.get("model")
+    if model and model not in app_config.MODEL_IDENTITIES:
+        return None
+    return result_cache.compute_cache_key(request_data.workflow_id, validated_params)
 
 @app.post("/generate", status_code=202)
-async def create_generation_task(request_data: GenerationRequest) -> Dict[str, str]:
+async def create_generation_task(
+    request_data: GenerationRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=255),
+    api_key: Optional[str] = Header(None, alias="X-API-Key"),
+) -> Dict[str, Any]:
     """
     Accepts a generation request, validates it, and enqueues it as a Celery task.
+
+    Duplicates are answered with an existing task instead of a new job:
+    a repeated `Idempotency-Key` returns the task it was first used for, an
+    identical request that is still queued or running is coalesced into it,
+    and requests with a fixed seed that were rendered before are answered from
+    the result cache with an already-completed task.
+
+    New work is subject to admission control: when the backlog is too deep or
+    would take too long to drain, or the `deadline` cannot be met, the request
+    is rejected with 503 and a `Retry-After` header.
+
+    When tenants are configured, the caller is identified by its `X-API-Key`. Its
+    tasks run at the tenant's priority, demoted while it uses more than its weighted
+    fair share, and are rejected with 429 beyond the tenant's concurrency cap.
     """
+    tenant = identify_tenant(api_key)
     try:
         validated_params = validate_request(request_data.workflow_id, request_data.params)
+        deadline = request_deadline(request_data)
     except ValueError as e:
         logger.error(f"Validation failed: {e}")
         raise HTTPException(status_code=400, detail=str(e))
     
     callback_url_str = str(request_data.callback_url) if request_data.callback_url else None
+    fingerprint = idempotency.request_fingerprint(request_data.workflow_id, request_data.params, callback_url_str)
+    if tenant is not None:
+        # Tenants never share tasks: coalescing across them would bypass the other
+        # tenant's concurrency cap and let one tenant cancel the other's work.
+        fingerprint = f"{tenant.name}:{fingerprint}"
+    task_id = str(uuid.uuid4())
+
+    if idempotency_key and tenant is not None:
+        # Keys are per tenant, so tenants can neither collide nor see each other's tasks.
+        idempotency_key = f"{tenant.name}:{idempotency_key}"
+    if idempotency_key:
+        bound_task_id, bound_fingerprint = await idempotency.claim_idempotency_key(idempotency_key, task_id, fingerprint)
+        if bound_task_id != task_id:
+            if bound_fingerprint != fingerprint:
+                raise HTTPException(status_code=409, detail="Idempotency-Key was already used for a different request.")
+            logger.info(f"Idempotency-Key replay: returning existing task {bound_task_id}.")
+            return {"task_id": bound_task_id, "deduplicated": True}
+
+    # Callback requests always run, so that the callback is delivered by a worker as usual.
+    cache_key = request_cache_key(request_data, validated_params)
+    if cache_key and not callback_url_str:
+        cached_result = await result_cache.lookup(cache_key)
+        if cached_result is not None:
+            await result_cache.replay(cached_result, task_id)
+            if tenant is not None:
+                await estimates.save_routes({task_id: {
+                    "queue": None,
+                    "priority": None,
+                    "tenant": tenant.name,
+                    "workflow_id": request_data.workflow_id,
+                    "params": validated_params,
+                }})
+            logger.info(f"Task {task_id} served from the result cache for workflow '{request_data.workflow_id}'.")
+            return {"task_id": task_id, "cached": True}
+
+    # Identical requests for a random seed are separate requests for new images; only an
+    # Idempotency-Key marks one of them as a retry.
+    coalesce = not uses_random_seed(request_data.params)
+    if coalesce:
+        inflight_task_id = await idempotency.claim_inflight(fingerprint, task_id)
+        if inflight_task_id != task_id:
+            if idempotency_key:
+                await idempotency.rebind_idempotency_key(idempotency_key, inflight_task_id, fingerprint)
+            logger.info(f"Request coalesced into in-flight task {inflight_task_id}.")
+            return {"task_id": inflight_task_id, "deduplicated": True}
+
+    try:
+        await admit(1, deadline)
+        priority = await admit_tenant(tenant, [task_id])
+        queue = await choose_queue(validated_params.get("model"), choose_lane(validated_params))
+        task = celery_app.send_task(
+            GENERATE_TASK_NAME,
+            kwargs={
+                "workflow_id": request_data.workflow_id,
+                "params": validated_params,
+                "callback_url": callback_url_str,
+                "cache_key": cache_key,
+                "tenant": tenant.name if tenant else None,
+            },
+            task_id=task_id,
+            queue=queue,
+            priority=priority,
+            expires=deadline,
+        )
+    except Exception:
+        if coalesce:
+            await idempotency.release_inflight(fingerprint, task_id)
+        if idempotency_key:
+            await idempotency.release_idempotency_key(idempotency_key, task_id)
+        if tenant is not None:
+            await release_slots(tenant.name, [task_id])
+        raise
     
-    task = generate_task.delay(
-        workflow_id=request_data.workflow_id,
-        params=validated_params,
-        callback_url=callback_url_str
-    )
-    
+    await estimates.save_routes({task.id: {
+        "queue": queue,
+        "priority": priority,
+        "tenant": tenant.name if tenant else None,
+        "workflow_id": request_data.workflow_id,
+        "params": validated_params,
+    }})
     logger.info(f"Task {task.id} enqueued for workflow '{request_data.workflow_id}'.")
     return {"task_id": task.id}
 
+class BatchGenerationRequest(BaseModel):
+    requests: List[GenerationRequest] = Field(..., min_length=1, max_length=MAX_BATCH_SIZE)
+
+@app.post("/generate/batch", status_code=202)
+async def create_generation_batch(
+    batch_data: BatchGenerationRequest,
+    api_key: Optional[str] = Header(None, alias="X-API-Key"),
+) -> Dict[str, Any]:
+    """
+    Validates all requests of a batch and enqueues them as a single Celery group.
+    Nothing is enqueued if any request is invalid, or if admission control or the
+    tenant's concurrency cap rejects the batch.
+    """
+    tenant = identify_tenant(api_key)
+    signatures = []
+    errors = []
+    deadlines = []
+    queues: Dict[Tuple[Optional[str], Optional[str]], str] = {}
+    for index, request_data in enumerate(batch_data.requests):
+        try:
+            validated_params = validate_request(request_data.workflow_id, request_data.params)
+            deadline = request_deadline(request_data)
+        except ValueError as e:
+            errors.append({"index": index, "error": str(e)})
+            continue
+        if deadline is not None:
+            deadlines.append(deadline)
+        route = (validated_params.get("model"), choose_lane(validated_params))
+        if route not in queues:
+            queues[route] = await choose_queue(*route)
+        signatures.append(celery_app.signature(
+            GENERATE_TASK_NAME,
+            kwargs={
+                "workflow_id": request_data.workflow_id,
+                "params": validated_params,
+                "callback_url": str(request_data.callback_url) if request_data.callback_url else None,
+                "cache_key": request_cache_key(request_data, validated_params),
+                "tenant": tenant.name if tenant else None,
+            },
+            # Set up front, so that the tenant's slots can be claimed before publishing.
+            task_id=str(uuid.uuid4()),
+            queue=queues[route],
+            expires=deadline,
+        ))
+
+    if errors:
+        logger.error(f"Batch validation failed for {len(errors)} of {len(batch_data.requests)} requests.")
+        raise HTTPException(status_code=400, detail=errors)
+
+    # The whole batch is admitted or rejected; its earliest deadline must hold for all of it.
+    await admit(len(signatures), min(deadlines, default=None))
+    task_ids = [signature.options["task_id"] for signature in signatures]
+    priority = await admit_tenant(tenant, task_ids)
+    for signature in signatures:
+        signature.set(priority=priority)
+
+    # Publishing the group is blocking broker I/O, so keep it off the event loop.
+    try:
+        group_result = await run_in_threadpool(group(signatures).apply_async)
+    except Exception:
+        if tenant is not None:
+            await release_slots(tenant.name, task_ids)
+        raise
+    await save_batch(group_result.id, task_ids, tenant.name if tenant else None)
+    await estimates.save_routes({
+        result.id: {
+            "queue": signature.options["queue"],
+            "priority": priority,
+            "tenant": signature.kwargs["tenant"],
+            "workflow_id": signature.kwargs["workflow_id"],
+            "params": signature.kwargs["params"],
+        }
+        for signature, result in zip(signatures, group_result.results)
+    })
+
+    logger.info(f"Batch {group_result.id} enqueued with {len(task_ids)} tasks.")
+    return {"batch_id": group_result.id, "task_ids": task_ids}
+
+@app.get("/batches/{batch_id}")
+async def get_batch_status(batch_id: str, api_key: Optional[str] = Header(None, alias="X-API-Key")) -> Dict[str, Any]:
+    """
+    Returns aggregate progress for a batch together with the status of each of its tasks.
+    With tenants configured, only the tenant that submitted the batch may read it.
+    """
+    tenant = identify_tenant(api_key)
+    batch = await load_batch(batch_id)
+    if batch is None or (tenant is not None and batch["tenant"] != tenant.name):
+        raise HTTPException(status_code=404, detail="Batch not found or expired.")
+    task_ids = batch["task_ids"]
+
+    metas = await fetch_task_metas(task_ids)
+    counts: Dict[str, int] = {}
+    progress_total = 0.0
+    for meta in metas:
+        status = meta["status"]
+        counts[status] = counts.get(status, 0) + 1
+        if status in states.READY_STATES:
+            progress_total += 100
+        elif status == 'PROGRESS' and isinstance(meta["result"], dict):
+            progress_total += meta["result"].get("percent", 0)
+
+    completed = sum(counts.get(status, 0) for status in states.READY_STATES)
+    return {
+        "batch_id": batch_id,
+        "total": len(task_ids),
+        "completed": completed,
+        "counts": counts,
+        "percent": round(progress_total / len(task_ids), 2) if task_ids else 100.0,
+        "tasks": [build_task_response(task_id, meta["status"], meta["result"]) for task_id, meta in zip(task_ids, metas)],
+    }
+
 @app.get("/loras", response_model=List[Dict[str, Any]])
 async def list_available_loras():
     """
@@ -84,60 +421,264 @@ async def list_available_loras():
         
     return response_data
 
+def result_file_paths(result: Any) -> List[str]:
+    """Returns all image paths of a successful task's result, including results stored before batching."""
+    if not isinstance(result, dict):
+        return []
+    return result.get('file_paths') or ([result['file_path']] if result.get('file_path') else [])
+
+def build_task_response(task_id: str, status: str, result: Any) -> Dict[str, Any]:
+    """Formats a task's state and stored result for API clients."""
+    response = {"task_id": task_id, "status": status}
+
+    if status == 'SUCCESS':
+        file_paths = result_file_paths(result)
+        if file_paths:
+            # Ensure PUBLIC_IP in .env is a full URL like http://127.0.0.1:8000
+            download_urls = [f"{app_config.PUBLIC_IP}/results/{task_id}/{os.path.basename(path)}" for path in file_paths]
+            response["result"] = {"download_url": download_urls[0], "download_urls": download_urls}
+        else:
+            response["result"] = "Task succeeded but no file path was returned."
+    elif status == 'FAILURE':
+        response["result"] = str(result)
+    elif status == 'PROGRESS':
+        response["progress"] = result
+    elif status == 'PENDING':
+        response["result"] = "Task is waiting in the queue."
+    elif status == 'REVOKED':
+        response["result"] = "Task was cancelled."
+
+    return response
+
+@app.get("/queues")
+async def get_queues() -> Dict[str, Any]:
+    """
+    Backlog per broker queue, the measured fleet throughput and the estimated
+    time to drain the backlog, e.g. as an autoscaling signal.
+    """
+    depths = await queue_depths()
+    rate = await completion_rate()
+    backlog = sum(depths.values())
+    return {
+        "queues": depths,
+        "backlog": backlog,
+        "tasks_per_second": rate,
+        "drain_seconds": round(backlog / rate, 1) if rate else None,
+    }
+
+@app.get("/workers")
+async def list_workers() -> List[Dict[str, Any]]:
+    """Lists the live workers known to the capability registry and what they can run."""
+    return [
+        {
+            "worker_id": worker_id,
+            "models": report["models"],
+            "loras": report["loras"],
+            "node_classes": len(report["node_classes"]),
+            "updated_at": report["updated_at"],
+        }
+        for worker_id, report in capability_registry.workers.items()
+    ]
+
 @app.get("/tasks/{task_id}")
-async def get_task_status(task_id: str) -> Dict[str, Any]:
+async def get_task_status(
+    task_id: str,
+    wait: float = Query(0, ge=0),
+    api_key: Optional[str] = Header(None, alias="X-API-Key"),
+) -> Dict[str, Any]:
     """
     Retrieves the status and result of a Celery task.
-    This runs the blocking Celery check in a threadpool to avoid blocking the event loop.
+
+    With `wait` (seconds), the request is held open until the task's status
+    changes or the timeout expires, and then returns the latest status.
+    Finished tasks always return immediately.
+
+    Unfinished tasks also report where they wait (`queue` in the broker, or
+    `backend_queue` inside ComfyUI) and an `eta_seconds` estimate.
     """
-    def check_celery_status():
-        """This synchronous function will be executed in a separate thread."""
-        task_result = celery_app.AsyncResult(task_id)
-        status = task_result.state
-        
-        response = {"task_id": task_id, "status": status}
-        
-        if status == 'SUCCESS':
-            result_data = task_result.result
-            file_path_str = result_data.get('file_path')
-            if file_path_str:
-                base_url = app_config.PUBLIC_IP
-                file_name = os.path.basename(file_path_str)
-                # Ensure PUBLIC_IP in .env is a full URL like http://127.0.0.1:8000
-                download_url = f"{base_url}/results/{task_id}/{file_name}"
-                response["result"] = {"download_url": download_url}
+    await authorize_task(task_id, api_key)
+    if wait > 0:
+        response = await wait_for_task_change(task_id, min(wait, app_config.TASK_LONG_POLL_MAX_WAIT))
+        if response["status"] in states.READY_STATES:
+            return response
+
+    # Re-read after a long-poll too: the queue details are only in the stored state.
+    meta = await fetch_task_meta(task_id)
+    response = build_task_response(task_id, meta["status"], meta["result"])
+
+    if meta["status"] not in states.READY_STATES:
+        response.update(await estimates.describe_wait(task_id, meta["status"], meta["result"]))
+    return response
+
+@app.delete("/tasks/{task_id}")
+async def cancel_task(task_id: str, api_key: Optional[str] = Header(None, alias="X-API-Key")) -> Dict[str, Any]:
+    """
+    Cancels a task. A task still in the broker queue is revoked and never runs;
+    a task whose prompt is queued in ComfyUI has it removed from ComfyUI's queue,
+    and a running one is interrupted, which frees the GPU right away.
+    """
+    route = await authorize_task(task_id, api_key)
+    # Every enqueued task has a stored route, and every started one a backend record.
+    if route is None and not await task_exists(task_id):
+        raise HTTPException(status_code=404, detail="Task not found.")
+    meta = await fetch_task_meta(task_id)
+    if meta["status"] in states.READY_STATES:
+        raise HTTPException(status_code=409, detail=f"Task already finished with status {meta['status']}.")
+
+    await request_cancel(task_id)
+    if route is not None and route.get("tenant"):
+        # A task revoked in the broker never runs, so its worker would not free the slot.
+        await release_slots(route["tenant"], [task_id])
+    # Broadcasting the revoke is blocking broker I/O, so keep it off the event loop.
+    await run_in_threadpool(celery_app.control.revoke, task_id)
+    if meta["status"] == states.PENDING and meta["result"] is None:
+        # No worker has touched the task yet, so nobody else will record the outcome soon.
+        await run_in_threadpool(celery_app.backend.mark_as_revoked, task_id, "cancelled")
+
+    logger.info(f"Cancellation requested for task {task_id}.")
+    return {"task_id": task_id, "status": states.REVOKED}
+
+class TaskStatusRequest(BaseModel):
+    task_ids: List[str] = Field(..., max_length=MAX_BULK_TASK_IDS)
+
+@app.post("/tasks/status")
+async def get_task_statuses(
+    request_data: TaskStatusRequest,
+    api_key: Optional[str] = Header(None, alias="X-API-Key"),
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Returns the status of many tasks at once, in the order they were requested.
+    All states are read from the result backend in a single round-trip.
+    With tenants configured, tasks of other tenants are reported as unknown (PENDING).
+    """
+    owned = await owned_task_ids(request_data.task_ids, api_key)
+    metas = iter(await fetch_task_metas([task_id for task_id, mine in zip(request_data.task_ids, owned) if mine]))
+    tasks = []
+    for task_id, mine in zip(request_data.task_ids, owned):
+        meta = next(metas) if mine else {"status": states.PENDING, "result": None}
+        tasks.append(build_task_response(task_id, meta["status"], meta["result"]))
+    return {"tasks": tasks}
+
+async def wait_for_task_change(task_id: str, timeout: float) -> Dict[str, Any]:
+    """Returns the task's next status, or its current one if nothing changes within `timeout` seconds."""
+    stream = task_status_stream(task_id)
+    try:
+        response = await stream.__anext__()
+        if response["status"] in states.READY_STATES:
+            return response
+
+        async def next_change() -> Dict[str, Any]:
+            async for update in stream:
+                if update is not None:
+                    return update
+            return response
+
+        try:
+            return await asyncio.wait_for(next_change(), timeout)
+        except asyncio.TimeoutError:
+            return response
+    finally:
+        await stream.aclose()
+
+async def task_status_stream(task_id: str) -> AsyncIterator[Optional[Dict[str, Any]]]:
+    """Yields formatted task states as they change; `None` marks an idle keep-alive."""
+    last_response = None
+    async for meta in watch_task(task_id, keepalive=EVENT_STREAM_KEEPALIVE):
+        if meta is None:
+            yield None
+            continue
+        response = build_task_response(task_id, meta["status"], meta["result"])
+        if response != last_response:
+            last_response = response
+            yield response
+
+@app.get("/tasks/{task_id}/events")
+async def stream_task_events(task_id: str, api_key: Optional[str] = Header(None, alias="X-API-Key")):
+    """
+    Streams the task's status as Server-Sent Events until it finishes.
+    Each event carries the same JSON body as GET /tasks/{task_id}.
+    """
+    await authorize_task(task_id, api_key)
+    async def event_source():
+        async for response in task_status_stream(task_id):
+            if response is None:
+                yield ": keep-alive\n\n"
             else:
-                response["result"] = "Task succeeded but no file path was returned."
-        elif status == 'FAILURE':
-            response["result"] = str(task_result.info)
-        elif status == 'PROGRESS':
-            response["progress"] = task_result.info
-        elif status == 'PENDING':
-            response["result"] = "Task is waiting in the queue."
-            
-        return response
-
-    # Execute the blocking function in the threadpool and await the result
-    return await run_in_threadpool(check_celery_status)
+                yield f"event: status\ndata: {json.dumps(response)}\n\n"
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.websocket("/tasks/{task_id}/ws")
+async def task_events_websocket(websocket: WebSocket, task_id: str, api_key: Optional[str] = Header(None, alias="X-API-Key")):
+    """WebSocket equivalent of /tasks/{task_id}/events. The server closes the socket when the task finishes."""
+    try:
+        await authorize_task(task_id, api_key)
+    except HTTPException:
+        await websocket.close(code=WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+
+    async def forward_events():
+        async for response in task_status_stream(task_id):
+            if response is not None:
+                await websocket.send_json(response)
+
+    async def wait_for_disconnect():
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    sender = asyncio.create_task(forward_events())
+    receiver = asyncio.create_task(wait_for_disconnect())
+    done, pending = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+
+    if sender in done:
+        try:
+            sender.result()
+            await websocket.close()
+        except WebSocketDisconnect:
+            pass
 
 @app.get("/results/{task_id}/{filename}")
-async def download_result_file(task_id: str, filename: str):
+async def download_result_file(task_id: str, filename: str, api_key: Optional[str] = Header(None, alias="X-API-Key")):
     """
-    Serves the generated image file for a completed task.
+    Serves a generated image of a completed task from the result storage: as a
+    file on a shared disk, streamed through the API, or (with RESULT_DOWNLOAD_MODE
+    "redirect") as a redirect to a URL where the storage serves it itself.
     """
-    task_result = celery_app.AsyncResult(task_id)
-    if not task_result.ready() or task_result.status != 'SUCCESS':
+    await authorize_task(task_id, api_key)
+    meta = await fetch_task_meta(task_id)
+    if meta["status"] != 'SUCCESS':
         raise HTTPException(status_code=404, detail="Task not found or not completed successfully.")
     
-    file_path = task_result.result.get('file_path')
-    if not file_path:
+    file_paths = result_file_paths(meta["result"])
+    if not file_paths:
         raise HTTPException(status_code=404, detail="File path not found in task result.")
     
-    if os.path.basename(file_path) != filename:
+    file_path = next((path for path in file_paths if os.path.basename(path) == filename), None)
+    if file_path is None:
         raise HTTPException(status_code=403, detail="Forbidden: Filename mismatch.")
-    
-    if os.path.exists(file_path):
-        return FileResponse(path=file_path, media_type='image/png', filename=filename)
-    else:
-        logger.error(f"Result file not found on disk for task {task_id}: {file_path}")
-        raise HTTPException(status_code=404, detail="Result file not found on disk.")
\ No newline at end of file
+
+    storage = storage_for(file_path)
+    if not await storage.exists(file_path):
+        logger.error(f"Result file not found in storage for task {task_id}: {file_path}")
+        raise HTTPException(status_code=404, detail="Result file not found in storage.")
+
+    if app_config.RESULT_DOWNLOAD_MODE == "redirect":
+        url = await storage.download_url(file_path, filename)
+        if url:
+            return RedirectResponse(url, status_code=307)
+
+    local_path = storage.local_path(file_path)
+    if local_path:
+        return FileResponse(path=local_path, media_type=media_type(filename), filename=filename)
+    return StreamingResponse(
+        storage.stream(file_path),
+        media_type=media_type(filename),
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
@@ -0,0 +1,306 @@
+# src/backends.py
+
+import asyncio
+import fcntl
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from .comfy_client import ComfyUIClient, worker_loop
+from .config import app_config, comfyui_path
+
+logger = logging.getLogger(__name__)
+
+class BackendUnavailable(RuntimeError):
+    """No healthy ComfyUI backend became available in time."""
+
+def set_pipe_size():
+    """
+    Increases the pipe buffer size for stdout/stderr on Linux.
+    This is called via preexec_fn and runs after fork() but before exec()
+    in the new child process. This helps prevent the ComfyUI process from
+    blocking if it generates a large amount of log output.
+    """
+    try:
+        # F_SETPIPE_SZ is available on Linux since kernel 2.6.35
+        # 134217728 bytes = 128 MB
+        # Set buffer size for stdout (file descriptor 1)
+        fcntl.fcntl(1, fcntl.F_SETPIPE_SZ, 134217728)
+        # And for stderr (file descriptor 2)
+        fcntl.fcntl(2, fcntl.F_SETPIPE_SZ, 134217728)
+    except (IOError, AttributeError, NameError) as e:
+        # If F_SETPIPE_SZ is not supported, it's not a critical error.
+        # uses os.write because standard logging might not be configured yet.
+        os.write(2, f"Could not set pipe size: {e}\n".encode())
+
+    # Also call the original function for process group management
+    if os.name == 'posix':
+        os.setpgrp()
+
+def probe(base_url: str, timeout: float = 5) -> bool:
+    """True if a ComfyUI server answers at `base_url`."""
+    try:
+        with urllib.request.urlopen(f"{base_url}/object_info", timeout=timeout) as response:
+            return response.status == 200
+    except Exception:
+        return False
+
+class ComfyBackend:
+    """
+    One ComfyUI server: either a subprocess spawned by this worker (optionally
+    pinned to one GPU), or a remote server given by URL.
+    """
+
+    def __init__(self, name: str, url: Optional[str] = None, device: Optional[str] = None, output_dir: Optional[Path] = None):
+        self.name = name
+        self.remote = url is not None
+        self.url = url
+        self.device = device
+        # Where this worker finds the backend's images. Remote images are downloaded here.
+        self.output_dir = output_dir or comfyui_path / "output"
+        self.process: Optional[subprocess.Popen] = None
+        self.client: Optional[ComfyUIClient] = None
+        self.healthy = False
+        self.outstanding = 0
+
+    def __repr__(self) -> str:
+        return f"<ComfyBackend {self.name} {self.url or 'not started'}>"
+
+    def start(self):
+        """Starts (or, for a remote server, waits for) the server and connects a client. Blocking."""
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        if self.remote:
+            self._wait_until_ready(self.url)
+        else:
+            self._spawn()
+        self.client = worker_loop.run(self._connect(self.client))
+
+    def _spawn(self):
+        logger.info(f"[{self.name}] Starting a fresh ComfyUI server instance on a random port...")
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind(('', 0))
+            port = s.getsockname()[1]
+
+        command = [
+            sys.executable, "main.py", "--port", str(port),
+            "--output-directory", str(self.output_dir),
+            "--preview-method", "none", "--dont-print-server", "--disable-auto-launch"
+        ]
+        env = dict(os.environ)
+        if self.device is not None:
+            env["CUDA_VISIBLE_DEVICES"] = self.device
+
+        self.process = subprocess.Popen(command, cwd=str(comfyui_path), env=env, preexec_fn=set_pipe_size)
+        url = f"http://127.0.0.1:{port}"
+        try:
+            self._wait_until_ready(url)
+        except Exception:
+            self.process.terminate()
+            self.process.wait()
+            raise
+        self.url = url
+
+    def _wait_until_ready(self, url: str):
+        for _ in range(app_config.COMFYUI_STARTUP_TIMEOUT):
+            if self.process is not None and self.process.poll() is not None:
+                raise RuntimeError(f"[{self.name}] ComfyUI process terminated unexpectedly during startup.")
+            if probe(url, timeout=1):
+                logger.info(f"[{self.name}] ComfyUI server is ready at {url}.")
+                return
+            time.sleep(1)
+        raise RuntimeError(f"[{self.name}] ComfyUI server at {url} did not become ready.")
+
+    async def _connect(self, old_client: Optional[ComfyUIClient]) -> ComfyUIClient:
+        if old_client:
+            await old_client.close()
+        client = ComfyUIClient(self.url, await worker_loop.get_session())
+        await client.start()
+        return client
+
+    def stop(self):
+        if self.client is not None:
+            try:
+                worker_loop.run(self.client.close(), timeout=10)
+            except Exception as e:
+                logger.warning(f"[{self.name}] Could not close the ComfyUI client: {e}")
+            self.client = None
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+
+    def is_alive(self) -> bool:
+        if not self.remote:
+            return self.process is not None and self.process.poll() is None
+        return probe(self.url)
+
+    async def queue_position(self, prompt_id: str) -> int:
+        """How many prompts ComfyUI will run before `prompt_id` (0 if it is running)."""
+        async with self.client.session.get(f"{self.url}/queue") as response:
+            response.raise_for_status()
+            queue = await response.json()
+        running = queue.get("queue_running", [])
+        if any(item[1] == prompt_id for item in running):
+            return 0
+        pending = queue.get("queue_pending", [])
+        number = next((item[0] for item in pending if item[1] == prompt_id), None)
+        if number is None:
+            return 0
+        return len(running) + sum(1 for item in pending if item[0] < number)
+
+    async def image_path(self, image: Dict[str, Any]) -> str:
+        """Resolves an image entry from a ComfyUI `images` output to a path on this worker's disk."""
+        path = self.output_dir / image.get("subfolder", "") / image["filename"]
+        if self.remote:
+            params = {"filename": image["filename"], "subfolder": image.get("subfolder", ""), "type": image.get("type", "output")}
+            async with self.client.session.get(f"{self.url}/view", params=params) as response:
+                response.raise_for_status()
+                data = await response.read()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            await asyncio.to_thread(path.write_bytes, data)
+        return str(path)
+
+class BackendPool:
+    """
+    The ComfyUI backends of one worker process.
+
+    Prompts are dispatched to the healthy backend with the fewest outstanding
+    prompts, and each backend holds at most PIPELINE_DEPTH of them (one running,
+    the rest waiting in ComfyUI's own queue). A backend that dies is taken out of rotation and restarted in the
+    background while the others keep serving; tasks wait for a backend only
+    when none is healthy.
+    """
+
+    def __init__(self):
+        self.backends: List[ComfyBackend] = []
+        self._cond = threading.Condition()
+        self._started = False
+        self._restarting: set = set()
+
+    def configure(self) -> List[ComfyBackend]:
+        """Builds the backend list from COMFYUI_LOCAL_DEVICES / COMFYUI_LOCAL_BACKENDS and COMFYUI_REMOTE_URLS."""
+        devices = app_config.COMFYUI_LOCAL_DEVICES or [None] * app_config.COMFYUI_LOCAL_BACKENDS
+        backends = []
+        for index, device in enumerate(devices):
+            # A lone local backend keeps ComfyUI's usual output directory.
+            output_dir = comfyui_path / "output" if len(devices) == 1 else comfyui_path / "output" / f"local-{index}"
+            backends.append(ComfyBackend(f"local-{index}", device=device, output_dir=output_dir))
+        for index, url in enumerate(app_config.COMFYUI_REMOTE_URLS):
+            backends.append(ComfyBackend(f"remote-{index}", url=url.rstrip("/"), output_dir=comfyui_path / "output" / f"remote-{index}"))
+        return backends
+
+    def ensure_started(self):
+        """Starts all backends once per process. Backends that fail to start are retried in the background."""
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+            self.backends = self.configure()
+
+        threads = [threading.Thread(target=self._start_backend, args=(backend,), daemon=True) for backend in self.backends]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        threading.Thread(target=self._monitor, name="comfy-backend-monitor", daemon=True).start()
+
+        healthy = sum(backend.healthy for backend in self.backends)
+        logger.info(f"{healthy} of {len(self.backends)} ComfyUI backends are ready.")
+        if not healthy:
+            raise BackendUnavailable("No ComfyUI backend could be started.")
+
+    def _start_backend(self, backend: ComfyBackend):
+        try:
+            backend.start()
+        except Exception as e:
+            logger.error(f"[{backend.name}] Failed to start: {e}")
+            self._schedule_restart(backend)
+            return
+        with self._cond:
+            backend.healthy = True
+            self._cond.notify_all()
+
+    @property
+    def server_urls(self) -> List[str]:
+        """The URLs of the healthy backends, e.g. for reading /object_info."""
+        return [backend.url for backend in self.backends if backend.healthy]
+
+    def acquire(self, timeout: Optional[float] = None) -> ComfyBackend:
+        """Reserves a pipeline slot on the least-loaded healthy backend for one prompt. Pair with `release`."""
+        self.ensure_started()
+        timeout = app_config.COMFYUI_STARTUP_TIMEOUT if timeout is None else timeout
+        with self._cond:
+            # Waiting for a busy backend's slot is fine; only give up when none is healthy.
+            while not self._cond.wait_for(lambda: self._pick() is not None, timeout):
+                if not any(backend.healthy for backend in self.backends):
+                    raise BackendUnavailable(f"No healthy ComfyUI backend within {timeout} seconds.")
+            backend = self._pick()
+            backend.outstanding += 1
+            return backend
+
+    def _pick(self) -> Optional[ComfyBackend]:
+        available = [backend for backend in self.backends if backend.healthy and backend.outstanding < app_config.PIPELINE_DEPTH]
+        return min(available, key=lambda backend: backend.outstanding, default=None)
+
+    def release(self, backend: ComfyBackend):
+        with self._cond:
+            backend.outstanding -= 1
+            self._cond.notify_all()
+
+    def check(self, backend: ComfyBackend) -> bool:
+        """Re-checks a backend after a failed prompt. A dead backend is restarted; returns its health."""
+        if backend.healthy and not backend.is_alive():
+            logger.warning(f"[{backend.name}] ComfyUI backend is down; taking it out of rotation.")
+            self._schedule_restart(backend)
+        return backend.healthy
+
+    def _schedule_restart(self, backend: ComfyBackend):
+        with self._cond:
+            backend.healthy = False
+            if backend.name in self._restarting:
+                return
+            self._restarting.add(backend.name)
+        threading.Thread(target=self._restart, args=(backend,), name=f"restart-{backend.name}", daemon=True).start()
+
+    def _restart(self, backend: ComfyBackend):
+        delay = 1.0
+        while True:
+            backend.stop()
+            try:
+                backend.start()
+                break
+            except Exception as e:
+                logger.error(f"[{backend.name}] Restart failed, retrying in {delay:.0f}s: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+        with self._cond:
+            self._restarting.discard(backend.name)
+            backend.healthy = True
+            self._cond.notify_all()
+        logger.info(f"[{backend.name}] ComfyUI backend is back in rotation at {backend.url}.")
+
+    def _monitor(self):
+        while True:
+            time.sleep(app_config.COMFYUI_HEALTH_INTERVAL)
+            for backend in self.backends:
+                try:
+                    self.check(backend)
+                except Exception as e:
+                    logger.warning(f"[{backend.name}] Health check failed: {e}")
+
+    def stop(self):
+        for backend in self.backends:
+            backend.stop()
+
+# Global pool instance, one per worker process.
+backend_pool = BackendPool()
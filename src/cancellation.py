@@ -0,0 +1,114 @@
+# src/cancellation.py
+
+import asyncio
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+from .config import app_config
+from .redis_client import get_async_redis, get_sync_redis
+
+if TYPE_CHECKING:
+    # Worker-only; the API imports this module without the ComfyUI client.
+    from .backends import ComfyBackend
+
+logger = logging.getLogger(__name__)
+
+# Cancellation requests are published on this channel, and also remembered under
+# a per-task key for tasks that start after the message was sent.
+CANCEL_CHANNEL = "comfy:cancel"
+CANCEL_KEY_PREFIX = "comfy:cancelled:"
+
+class TaskCancelled(Exception):
+    """Raised in a task whose prompt was cancelled."""
+
+def cancel_key(task_id: str) -> str:
+    return f"{CANCEL_KEY_PREFIX}{task_id}"
+
+async def request_cancel(task_id: str):
+    """API side: asks whichever worker runs (or will run) the task to cancel it."""
+    redis = get_async_redis()
+    await redis.set(cancel_key(task_id), 1, ex=app_config.CANCEL_TTL)
+    await redis.publish(CANCEL_CHANNEL, task_id)
+
+def is_cancelled(task_id: str) -> bool:
+    return bool(get_sync_redis().exists(cancel_key(task_id)))
+
+async def cancel_prompt(backend: "ComfyBackend", prompt_id: str, task_id: str):
+    """
+    Frees the GPU from a prompt: a queued prompt is deleted from ComfyUI's queue and
+    a running one is interrupted. The task waiting on the prompt is woken up with
+    TaskCancelled, so it does not have to wait for ComfyUI to notice.
+    """
+    client = backend.client
+    async with client.session.get(f"{backend.url}/queue") as response:
+        response.raise_for_status()
+        queue = await response.json()
+
+    if any(item[1] == prompt_id for item in queue.get("queue_running", [])):
+        # Newer ComfyUI versions only interrupt if `prompt_id` is still the one running.
+        async with client.session.post(f"{backend.url}/interrupt", json={"prompt_id": prompt_id}) as response:
+            response.raise_for_status()
+        logger.info(f"[{task_id}] Interrupted running prompt {prompt_id} on {backend.name}.")
+    else:
+        async with client.session.post(f"{backend.url}/queue", json={"delete": [prompt_id]}) as response:
+            response.raise_for_status()
+        logger.info(f"[{task_id}] Removed queued prompt {prompt_id} from {backend.name}.")
+
+    client.fail_prompt(prompt_id, TaskCancelled(f"Task {task_id} was cancelled."))
+
+class CancellationWatcher:
+    """
+    Worker side: listens for cancellation requests and cancels the matching
+    prompt if it is queued or running on one of this worker's backends.
+    """
+
+    def __init__(self):
+        # Task ID -> (backend, prompt ID) of the prompts this worker process has in ComfyUI.
+        self._prompts: Dict[str, Tuple["ComfyBackend", str]] = {}
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """Starts listening. `loop` is the worker event loop the backends' clients live on."""
+        if self._thread is not None:
+            return
+        self._loop = loop
+        self._thread = threading.Thread(target=self._run, name="cancellation-watcher", daemon=True)
+        self._thread.start()
+
+    def register(self, task_id: str, backend: "ComfyBackend", prompt_id: str):
+        with self._lock:
+            self._prompts[task_id] = (backend, prompt_id)
+
+    def unregister(self, task_id: str):
+        with self._lock:
+            self._prompts.pop(task_id, None)
+
+    def _run(self):
+        while True:
+            try:
+                pubsub = get_sync_redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CANCEL_CHANNEL)
+                for message in pubsub.listen():
+                    self._cancel(message["data"])
+            except Exception as e:
+                logger.warning(f"Cancellation listener failed, reconnecting: {e}")
+                time.sleep(1)
+
+    def _cancel(self, task_id: str):
+        with self._lock:
+            entry = self._prompts.get(task_id)
+        if entry is None:
+            return
+        backend, prompt_id = entry
+        future = asyncio.run_coroutine_threadsafe(cancel_prompt(backend, prompt_id, task_id), self._loop)
+        try:
+            future.result(30)
+        except Exception as e:
+            logger.error(f"[{task_id}] Could not cancel prompt {prompt_id} on {backend.name}: {e}")
+
+# Global watcher instance, one per worker process.
+cancellation_watcher = CancellationWatcher()
@@ -0,0 +1,197 @@
+# src/capabilities.py
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import urllib.request
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from .config import app_config, comfyui_path
+from .model_index import ModelIndex
+from .redis_client import get_async_redis, get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+# Hash of worker ID -> JSON capability report.
+WORKERS_KEY = "comfy:workers"
+
+# Loader node inputs whose choices list the model and LoRA files a ComfyUI server can load.
+MODEL_INPUTS = (("UnetLoaderGGUF", "unet_name"), ("UNETLoader", "unet_name"), ("CheckpointLoaderSimple", "ckpt_name"))
+LORA_INPUTS = (("LoraLoader", "lora_name"), ("LoraLoaderModelOnly", "lora_name"))
+
+def combo_choices(object_info: Dict[str, Any], node_class: str, input_name: str) -> List[str]:
+    """Returns the choices of a combo input from ComfyUI's /object_info, in either of its formats."""
+    inputs = object_info.get(node_class, {}).get("input", {})
+    spec = inputs.get("required", {}).get(input_name) or inputs.get("optional", {}).get(input_name)
+    if not spec:
+        return []
+    if isinstance(spec[0], list):
+        return spec[0]
+    if spec[0] == "COMBO" and len(spec) > 1:
+        return spec[1].get("options", [])
+    return []
+
+def extract_capabilities(object_info: Dict[str, Any]) -> Dict[str, List[str]]:
+    """Reduces ComfyUI's /object_info to the models, LoRAs and node classes it offers."""
+    models = {name for node_class, input_name in MODEL_INPUTS for name in combo_choices(object_info, node_class, input_name)}
+    loras = {name for node_class, input_name in LORA_INPUTS for name in combo_choices(object_info, node_class, input_name)}
+    loras.add("None")
+    return {
+        "models": sorted(models),
+        "loras": sorted(loras),
+        "node_classes": sorted(object_info.keys()),
+    }
+
+def intersect_capabilities(reports: List[Dict[str, List[str]]]) -> Dict[str, List[str]]:
+    """What every one of several ComfyUI servers offers, since a prompt may run on any of them."""
+    return {kind: sorted(set.intersection(*(set(report[kind]) for report in reports))) for kind in reports[0]}
+
+def missing_capabilities(capabilities: Dict[str, Any], workflow: Dict[str, Any]) -> List[str]:
+    """The node types, models and LoRAs a populated workflow uses that a capability report lacks."""
+    kinds = {**{inputs: "models" for inputs in MODEL_INPUTS}, **{inputs: "loras" for inputs in LORA_INPUTS}}
+    missing = []
+    for node in workflow.values():
+        class_type = node.get("class_type")
+        if class_type not in capabilities["node_classes"]:
+            missing.append(f"node type {class_type}")
+            continue
+        for input_name, value in (node.get("inputs") or {}).items():
+            kind = kinds.get((class_type, input_name))
+            if kind and isinstance(value, str) and value not in capabilities[kind]:
+                missing.append(value)
+    return missing
+
+def combine_identities(reports: Iterable[Dict[str, Any]]) -> Dict[str, str]:
+    """
+    One identity per model across workers, independent of report order. Workers may
+    disagree while a model file is being rolled out, so all of their identities are
+    combined. A model offered by a worker that cannot identify its file (e.g. one with
+    remote backends) gets none, which keeps its results out of the result cache.
+    """
+    identities: Dict[str, Set[str]] = {}
+    unidentified: Set[str] = set()
+    for report in reports:
+        reported = report.get("model_identities", {})
+        for name in report["models"]:
+            if name in reported:
+                identities.setdefault(name, set()).add(reported[name])
+            else:
+                unidentified.add(name)
+    return {name: "|".join(sorted(values)) for name, values in identities.items() if name not in unidentified}
+
+def is_live(report: Dict[str, Any]) -> bool:
+    return report.get("updated_at", 0) >= time.time() - 3 * app_config.CAPABILITY_HEARTBEAT_INTERVAL
+
+class CapabilityPublisher:
+    """
+    Worker side: reports what this worker's ComfyUI servers can run to the
+    registry in Redis. With several backends, that is what all of the healthy ones
+    offer. The report is re-sent on every heartbeat, and /object_info and the
+    local model index are re-read every CAPABILITY_REFRESH_INTERVAL seconds, or
+    when the set of healthy backends changes.
+    """
+
+    def __init__(self, get_server_urls: Callable[[], List[str]], has_local_models: Callable[[], bool] = lambda: True):
+        self.get_server_urls = get_server_urls
+        # Whether the local ComfyUI/models directory holds the files the backends load.
+        self.has_local_models = has_local_models
+        self.worker_id: Optional[str] = None
+        self.capabilities: Optional[Dict[str, Any]] = None
+        self.model_index: Optional[ModelIndex] = None
+        self._server_urls: List[str] = []
+        self._refreshed_at = 0.0
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Starts heartbeating. Must be called in the worker process itself (after fork)."""
+        if self._thread is not None:
+            return
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._thread = threading.Thread(target=self._run, name="capability-publisher", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.publish()
+            except Exception as e:
+                logger.warning(f"Could not publish worker capabilities: {e}")
+            time.sleep(app_config.CAPABILITY_HEARTBEAT_INTERVAL)
+
+    def publish(self):
+        server_urls = self.get_server_urls()
+        if not server_urls:
+            return
+        if (self.capabilities is None or server_urls != self._server_urls
+                or time.time() - self._refreshed_at >= app_config.CAPABILITY_REFRESH_INTERVAL):
+            reports = []
+            for server_url in server_urls:
+                with urllib.request.urlopen(f"{server_url}/object_info", timeout=30) as response:
+                    reports.append(extract_capabilities(json.load(response)))
+            capabilities: Dict[str, Any] = intersect_capabilities(reports)
+            # Remote backends load their own files, which the local model index knows nothing about.
+            capabilities["model_identities"] = self._model_identities() if self.has_local_models() else {}
+            self.capabilities = capabilities
+            self._server_urls = server_urls
+            self._refreshed_at = time.time()
+
+        report = dict(self.capabilities, worker_id=self.worker_id, updated_at=time.time())
+        get_sync_redis().hset(WORKERS_KEY, self.worker_id, json.dumps(report))
+
+    def _model_identities(self) -> Dict[str, str]:
+        """Identities of the local model files, so the API can tell when one is replaced."""
+        try:
+            if self.model_index is None:
+                self.model_index = ModelIndex(comfyui_path / "models", app_config.MODEL_INDEX_PATH, hash_contents=app_config.MODEL_INDEX_HASH)
+                self.model_index.load()
+            if self.model_index.refresh():
+                self.model_index.save()
+            return self.model_index.identities("models")
+        except Exception as e:
+            logger.warning(f"Could not refresh the model index: {e}")
+            return {}
+
+    def withdraw(self):
+        """Removes this worker from the registry, e.g. on shutdown."""
+        if self.worker_id:
+            get_sync_redis().hdel(WORKERS_KEY, self.worker_id)
+
+class CapabilityRegistry:
+    """
+    API side: keeps a snapshot of the union of what live workers report and
+    publishes it as `app_config.AVAILABLE_MODELS` / `AVAILABLE_LORAS` /
+    `AVAILABLE_NODE_CLASSES` / `MODEL_IDENTITIES`, so request validation stays synchronous.
+    """
+
+    def __init__(self):
+        self.workers: Dict[str, Dict[str, Any]] = {}
+
+    async def refresh(self):
+        redis = get_async_redis()
+        reports = {worker_id: json.loads(raw) for worker_id, raw in (await redis.hgetall(WORKERS_KEY)).items()}
+
+        stale = [worker_id for worker_id, report in reports.items() if not is_live(report)]
+        if stale:
+            await redis.hdel(WORKERS_KEY, *stale)
+        self.workers = {worker_id: report for worker_id, report in reports.items() if worker_id not in stale}
+
+        app_config.AVAILABLE_MODELS = {name for report in self.workers.values() for name in report["models"]}
+        app_config.AVAILABLE_LORAS = {name for report in self.workers.values() for name in report["loras"]} | {"None"}
+        app_config.AVAILABLE_NODE_CLASSES = {name for report in self.workers.values() for name in report["node_classes"]}
+        app_config.MODEL_IDENTITIES = combine_identities(self.workers.values())
+
+    async def run(self):
+        """Refreshes the snapshot forever; meant to run as a background task."""
+        while True:
+            await asyncio.sleep(app_config.CAPABILITY_POLL_INTERVAL)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning(f"Could not refresh worker capabilities: {e}")
+
+# Global registry instance, one per API process.
+capability_registry = CapabilityRegistry()
@@ -1,9 +1,14 @@
 # src/celery_app.py
 
 from celery import Celery
+from kombu import Queue
 
 # Use a relative import
 from .config import app_config
+from .scheduling import PRIORITY_LEVELS, PRIORITY_SEPARATOR, lane_queues
+
+# The API enqueues tasks by name, so that it never has to import the worker module.
+GENERATE_TASK_NAME = "generate_task"
 
 celery_app = Celery(
     'comfy_tasks',
@@ -18,4 +23,21 @@ celery_app.conf.update(
     result_serializer='json',
     timezone='UTC',
     enable_utc=True,
-)
\ No newline at end of file
+    task_default_queue=app_config.CELERY_DEFAULT_QUEUE,
+    # Workers consume every lane of the shared queue (see src/scheduling.py).
+    task_queues=[Queue(name) for name in lane_queues(app_config.CELERY_DEFAULT_QUEUE)],
+    # One broker list per priority level, so that tenant priorities take effect (see src/scheduling.py).
+    broker_transport_options={"priority_steps": PRIORITY_LEVELS, "sep": PRIORITY_SEPARATOR},
+    # Reserve only the task being executed. Prefetched tasks would be taken
+    # regardless of which model they need, defeating model-affinity routing.
+    worker_prefetch_multiplier=1,
+)
+
+if app_config.PIPELINE_DEPTH > 1:
+    # Pipelined execution: one thread per prompt that may be queued inside ComfyUI. With
+    # late acks and a prefetch multiplier of 1, each thread reserves exactly one task and
+    # acknowledges it when its result arrives, independently of the others.
+    celery_app.conf.update(
+        worker_pool="threads",
+        worker_concurrency=app_config.PIPELINE_DEPTH * app_config.comfyui_backend_count,
+    )
\ No newline at end of file
@@ -0,0 +1,211 @@
+# src/comfy_client.py
+
+import asyncio
+import json
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Any, Coroutine, Dict, List, Optional, Tuple
+
+import aiohttp
+
+from .config import app_config
+
+logger = logging.getLogger(__name__)
+
+# How many prompts' worth of messages to hold for prompt IDs nobody is watching yet.
+UNCLAIMED_PROMPTS_LIMIT = 64
+
+# Binary WebSocket frames start with a big-endian event type; image frames (sent for
+# previews and by SaveImageWebsocket) follow it with an image format code and the image.
+BINARY_EVENT_PREVIEW_IMAGE = 1
+BINARY_IMAGE_FORMATS = {1: "jpeg", 2: "png"}
+
+class WorkerEventLoop:
+    """
+    One asyncio event loop per worker process, running in a daemon thread.
+    Synchronous Celery task code hands coroutines to it with `run`, so
+    connections opened on the loop survive from one task to the next.
+    """
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    self._thread = threading.Thread(target=loop.run_forever, name="worker-event-loop", daemon=True)
+                    self._thread.start()
+                    self._loop = loop
+        return self._loop
+
+    def run(self, coro: Coroutine, timeout: Optional[float] = None) -> Any:
+        """Runs a coroutine on the worker loop and blocks until it finishes."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Returns the pooled HTTP session shared by everything on this loop."""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+# Global loop instance, created lazily in each worker process.
+worker_loop = WorkerEventLoop()
+
+class ComfyUIClient:
+    """
+    A persistent connection to one ComfyUI server.
+
+    A single WebSocket is kept open for the lifetime of the client and its
+    messages are dispatched to per-prompt queues by `prompt_id`.
+    All methods must be called on the worker event loop.
+    """
+
+    def __init__(self, base_url: str, session: aiohttp.ClientSession):
+        self.base_url = base_url
+        self.session = session
+        self.client_id = str(uuid.uuid4())
+        self._prompt_queues: Dict[str, asyncio.Queue] = {}
+        self._unclaimed: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        self._connected = asyncio.Event()
+        self._listener: Optional[asyncio.Task] = None
+        # (prompt ID, node ID) ComfyUI is executing. Binary frames carry no prompt ID,
+        # but ComfyUI runs one node at a time, so they belong to this node.
+        self._executing: Optional[Tuple[str, str]] = None
+
+    @property
+    def ws_url(self) -> str:
+        return f"{self.base_url.replace('http://', 'ws://', 1)}/ws?clientId={self.client_id}"
+
+    async def start(self, timeout: float = 10):
+        """Starts the WebSocket listener and waits until it is connected."""
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+        await asyncio.wait_for(self._connected.wait(), timeout)
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._fail_waiters(ConnectionError("ComfyUI client was closed."))
+
+    async def _listen(self):
+        """Keeps the WebSocket open, reconnecting with the same client ID if it drops."""
+        while True:
+            try:
+                async with self.session.ws_connect(self.ws_url, heartbeat=30) as ws:
+                    self._connected.set()
+                    logger.info(f"WebSocket connected to {self.base_url} (client_id: {self.client_id}).")
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self._dispatch(json.loads(msg.data))
+                        elif msg.type == aiohttp.WSMsgType.BINARY:
+                            self._dispatch_binary(msg.data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"WebSocket to {self.base_url} failed: {e}")
+
+            self._connected.clear()
+            self._executing = None
+            self._fail_waiters(TimeoutError("WebSocket connection closed before the completion signal was received."))
+            await asyncio.sleep(1)
+
+    def _dispatch(self, message: Dict[str, Any]):
+        data = message.get('data') or {}
+        prompt_id = data.get('prompt_id')
+        if not prompt_id:
+            return
+        if message.get('type') == 'executing':
+            self._executing = (prompt_id, data['node']) if data.get('node') is not None else None
+
+        queue = self._prompt_queues.get(prompt_id)
+        if queue is not None:
+            queue.put_nowait(message)
+            return
+
+        # The message may have raced ahead of the /prompt response; keep it briefly.
+        self._unclaimed.setdefault(prompt_id, []).append(message)
+        while len(self._unclaimed) > UNCLAIMED_PROMPTS_LIMIT:
+            self._unclaimed.popitem(last=False)
+
+    def _dispatch_binary(self, frame: bytes):
+        """Turns an image frame into an `output_image` message for the prompt being executed."""
+        if len(frame) < 8 or self._executing is None:
+            return
+        if int.from_bytes(frame[:4], "big") != BINARY_EVENT_PREVIEW_IMAGE:
+            return
+        prompt_id, node_id = self._executing
+        self._dispatch({
+            'type': 'output_image',
+            'data': {
+                'prompt_id': prompt_id,
+                'node': node_id,
+                'format': BINARY_IMAGE_FORMATS.get(int.from_bytes(frame[4:8], "big"), "png"),
+                'image': frame[8:],
+            },
+        })
+
+    def _fail_waiters(self, error: Exception):
+        for queue in self._prompt_queues.values():
+            queue.put_nowait(error)
+
+    def fail_prompt(self, prompt_id: str, error: Exception):
+        """Wakes up whoever waits on a prompt's messages with `error`."""
+        queue = self._prompt_queues.get(prompt_id)
+        if queue is not None:
+            queue.put_nowait(error)
+
+    def watch(self, prompt_id: str) -> asyncio.Queue:
+        """Registers interest in a prompt's messages and returns its queue."""
+        queue = self._prompt_queues.get(prompt_id)
+        if queue is None:
+            queue = self._prompt_queues[prompt_id] = asyncio.Queue()
+            for message in self._unclaimed.pop(prompt_id, []):
+                queue.put_nowait(message)
+        return queue
+
+    def unwatch(self, prompt_id: str):
+        self._prompt_queues.pop(prompt_id, None)
+        self._unclaimed.pop(prompt_id, None)
+
+    async def next_message(self, prompt_id: str) -> Dict[str, Any]:
+        """Waits for the next message about a watched prompt."""
+        message = await asyncio.wait_for(self.watch(prompt_id).get(), app_config.CELERY_TASK_AIOHTTP_TIMEOUT)
+        if isinstance(message, Exception):
+            raise message
+        return message
+
+    async def queue_prompt(self, workflow: Dict[str, Any]) -> str:
+        """Submits a workflow to ComfyUI's queue and starts watching it."""
+        prompt_id = str(uuid.uuid4())
+        self.watch(prompt_id)
+
+        prompt_data = {'prompt': workflow, 'client_id': self.client_id, 'prompt_id': prompt_id}
+        try:
+            async with self.session.post(f"{self.base_url}/prompt", json=prompt_data) as response:
+                response.raise_for_status()
+                result = await response.json()
+        except Exception:
+            self.unwatch(prompt_id)
+            raise
+
+        returned_id = result.get("prompt_id")
+        if not returned_id:
+            self.unwatch(prompt_id)
+            raise ValueError("API call to /prompt did not return a prompt_id.")
+        if returned_id != prompt_id:
+            # Older ComfyUI versions assign their own prompt IDs.
+            self.unwatch(prompt_id)
+            self.watch(returned_id)
+        return returned_id
@@ -1,9 +1,8 @@
 # src/config.py
 
 import os
-import sys
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional, Set
 from dotenv import load_dotenv
 
 # --- Load .env ---
@@ -11,13 +10,11 @@ project_root_for_env = Path(__file__).resolve().parent.parent
 load_dotenv(dotenv_path=project_root_for_env / '.env')
 
 # --- Path Configuration ---
-# This ensures that ComfyUI's internal modules can be imported by our service.
+# ComfyUI only ever runs as a subprocess of the workers; this service never imports it.
 project_root = Path(__file__).resolve().parent.parent
 comfyui_path = project_root / "ComfyUI"
-if str(comfyui_path) not in sys.path:
-    sys.path.insert(0, str(comfyui_path))
 
-import folder_paths
+from .model_index import ModelIndex
 
 class AppConfig:
     """
@@ -48,79 +45,217 @@ class AppConfig:
             redis_db = os.getenv("REDIS_DB", "0")
             cls._instance.CELERY_BROKER_URL = f"redis://:{redis_password}@{redis_host}:{redis_port}/{redis_db}"
             cls._instance.CELERY_BACKEND_URL = cls._instance.CELERY_BROKER_URL
+            # The shared queue every worker consumes.
+            cls._instance.CELERY_DEFAULT_QUEUE = os.getenv("CELERY_DEFAULT_QUEUE", "celery")
+
+            # --- Model Affinity ---
+            # Tasks are routed to per-model queues consumed by workers that already have the model loaded.
+            # A model queue with more than AFFINITY_SPILLOVER_DEPTH tasks per resident worker
+            # spills over to the shared queue, and idle workers adopt backed-up model queues.
+            cls._instance.AFFINITY_ENABLED = os.getenv("AFFINITY_ENABLED", "true").lower() == "true"
+            cls._instance.AFFINITY_HEARTBEAT_INTERVAL = float(os.getenv("AFFINITY_HEARTBEAT_INTERVAL", 10))
+            cls._instance.AFFINITY_SPILLOVER_DEPTH = int(os.getenv("AFFINITY_SPILLOVER_DEPTH", 4))
+
+            # --- Cost-Aware Scheduling ---
+            # A job's cost is width × height (in megapixels) × steps × batch_size, times the
+            # model's factor in MODEL_COST_FACTORS (e.g. "flux1-dev.safetensors=2,sdxl.safetensors=0.5")
+            # and FBC_COST_FACTOR if First Block Cache is on. Jobs costing at most PREVIEW_MAX_COST
+            # go to the ".preview" lane of their queue, so they do not wait behind large renders.
+            cls._instance.PREVIEW_LANE_ENABLED = os.getenv("PREVIEW_LANE_ENABLED", "true").lower() == "true"
+            cls._instance.PREVIEW_MAX_COST = float(os.getenv("PREVIEW_MAX_COST", 8))
+            cls._instance.MODEL_COST_FACTORS: Dict[str, float] = {
+                name.strip(): float(factor)
+                for name, _, factor in (item.partition("=") for item in os.getenv("MODEL_COST_FACTORS", "").split(","))
+                if name.strip() and factor.strip()
+            }
+            cls._instance.FBC_COST_FACTOR = float(os.getenv("FBC_COST_FACTOR", 0.6))
+
+            # --- Tenants ---
+            # API keys, priorities, fair-share weights and concurrency caps per tenant (see
+            # tenants.example.yaml). Without the file, the API is open to everyone. A slot is
+            # freed when its task finishes; TENANT_INFLIGHT_TTL is only a safety net for tasks
+            # that are lost (e.g. expired in the queue), counted from enqueue and again from start.
+            cls._instance.TENANTS_FILE = Path(os.getenv("TENANTS_FILE", project_root / "tenants.yaml"))
+            cls._instance.TENANT_INFLIGHT_TTL = int(os.getenv("TENANT_INFLIGHT_TTL", 86400))
+
+            # --- ComfyUI Backends ---
+            # Each worker process drives a pool of ComfyUI servers: COMFYUI_LOCAL_BACKENDS spawned
+            # subprocesses, or one per GPU listed in COMFYUI_LOCAL_DEVICES (e.g. "0,1"), plus any
+            # servers in COMFYUI_REMOTE_URLS (comma-separated). Run the worker with
+            # `--pool threads -c <number of backends>` to keep them all busy.
+            cls._instance.COMFYUI_LOCAL_BACKENDS = int(os.getenv("COMFYUI_LOCAL_BACKENDS", 1))
+            cls._instance.COMFYUI_LOCAL_DEVICES: List[str] = [d.strip() for d in os.getenv("COMFYUI_LOCAL_DEVICES", "").split(",") if d.strip()]
+            cls._instance.COMFYUI_REMOTE_URLS: List[str] = [u.strip() for u in os.getenv("COMFYUI_REMOTE_URLS", "").split(",") if u.strip()]
+            # Seconds between backend health checks, and how often a task whose backend died is retried.
+            cls._instance.COMFYUI_HEALTH_INTERVAL = float(os.getenv("COMFYUI_HEALTH_INTERVAL", 10))
+            cls._instance.COMFYUI_BACKEND_RETRIES = int(os.getenv("COMFYUI_BACKEND_RETRIES", 2))
+            # Prompts kept queued inside each ComfyUI backend. With more than one, the next prompt
+            # is already waiting when the current one finishes, so the GPU does not idle while a
+            # task fetches its outputs and sends its callback. Values above 1 switch the worker to
+            # a threads pool with one slot (and one prefetched task) per queued prompt.
+            cls._instance.PIPELINE_DEPTH = max(1, int(os.getenv("PIPELINE_DEPTH", 1)))
 
             # --- Timeout Settings (seconds) ---
             cls._instance.COMFYUI_STARTUP_TIMEOUT = int(os.getenv("COMFYUI_STARTUP_TIMEOUT", 120))
             cls._instance.CELERY_TASK_TIME_LIMIT = int(os.getenv("CELERY_TASK_TIME_LIMIT", 600))
             cls._instance.CELERY_TASK_AIOHTTP_TIMEOUT = int(os.getenv("CELERY_TASK_AIOHTTP_TIMEOUT", 300))
 
+            # --- Admission Control ---
+            # POST /generate is rejected with 503 and a Retry-After when more than
+            # ADMISSION_MAX_QUEUE_DEPTH tasks are waiting, or when the backlog would take more than
+            # ADMISSION_MAX_DRAIN_SECONDS to drain at the throughput measured over the last
+            # THROUGHPUT_WINDOW seconds (0 disables either limit). Without throughput data,
+            # clients are asked to retry after ADMISSION_DEFAULT_RETRY_AFTER seconds.
+            cls._instance.ADMISSION_MAX_QUEUE_DEPTH = int(os.getenv("ADMISSION_MAX_QUEUE_DEPTH", 0))
+            cls._instance.ADMISSION_MAX_DRAIN_SECONDS = float(os.getenv("ADMISSION_MAX_DRAIN_SECONDS", 0))
+            cls._instance.ADMISSION_DEFAULT_RETRY_AFTER = int(os.getenv("ADMISSION_DEFAULT_RETRY_AFTER", 30))
+            cls._instance.THROUGHPUT_WINDOW = float(os.getenv("THROUGHPUT_WINDOW", 300))
+
+            # --- Queue Position & ETA ---
+            # Execution times are tracked per workflow and resolution as a moving average
+            # (weight of the newest sample: ESTIMATE_ALPHA). A task's broker queue position is
+            # looked up among the QUEUE_POSITION_SCAN_LIMIT messages next in line.
+            cls._instance.ESTIMATE_ALPHA = float(os.getenv("ESTIMATE_ALPHA", 0.2))
+            cls._instance.QUEUE_POSITION_SCAN_LIMIT = int(os.getenv("QUEUE_POSITION_SCAN_LIMIT", 1000))
+
+            # How long a cancellation request is remembered for a task that has not started yet.
+            cls._instance.CANCEL_TTL = int(os.getenv("CANCEL_TTL", 86400))
+
+            # Upper bound for the `wait` parameter of GET /tasks/{task_id} (long-poll).
+            cls._instance.TASK_LONG_POLL_MAX_WAIT = float(os.getenv("TASK_LONG_POLL_MAX_WAIT", 60))
+
+            # --- Progress Reporting ---
+            # Progress updates are coalesced: at most one write per interval (seconds),
+            # and only when progress moved by at least the given number of percent.
+            cls._instance.PROGRESS_MIN_INTERVAL = float(os.getenv("PROGRESS_MIN_INTERVAL", 0.5))
+            cls._instance.PROGRESS_MIN_PERCENT_DELTA = float(os.getenv("PROGRESS_MIN_PERCENT_DELTA", 5))
+
+            # --- Model Discovery ---
+            # "registry": validate against what live workers report (the API host needs no model files).
+            # "filesystem": scan the local ComfyUI model directories at startup.
+            cls._instance.MODEL_DISCOVERY = os.getenv("MODEL_DISCOVERY", "registry").lower()
+            # Workers heartbeat their capabilities every CAPABILITY_HEARTBEAT_INTERVAL seconds and
+            # re-read ComfyUI's /object_info every CAPABILITY_REFRESH_INTERVAL seconds.
+            # The API re-reads the registry every CAPABILITY_POLL_INTERVAL seconds.
+            cls._instance.CAPABILITY_HEARTBEAT_INTERVAL = float(os.getenv("CAPABILITY_HEARTBEAT_INTERVAL", 10))
+            cls._instance.CAPABILITY_REFRESH_INTERVAL = float(os.getenv("CAPABILITY_REFRESH_INTERVAL", 60))
+            cls._instance.CAPABILITY_POLL_INTERVAL = float(os.getenv("CAPABILITY_POLL_INTERVAL", 5))
+            # A worker that picks up a task it cannot run sends it back to the shared queue,
+            # at most CAPABILITY_REROUTES times before the task fails.
+            cls._instance.CAPABILITY_REROUTES = int(os.getenv("CAPABILITY_REROUTES", 3))
+
+            # --- Manifests ---
+            # The YAML manifests are checked for changes at most every MANIFEST_RELOAD_INTERVAL
+            # seconds and reloaded without a restart (0 disables reloading).
+            cls._instance.MANIFEST_RELOAD_INTERVAL = float(os.getenv("MANIFEST_RELOAD_INTERVAL", 2))
+
+            # --- Model Index ---
+            # Model files are indexed once and the index is persisted, so startup does not
+            # re-walk the model directories. The index is refreshed incrementally every
+            # MODEL_INDEX_REFRESH_INTERVAL seconds (0 disables it). MODEL_INDEX_HASH also records a
+            # SHA-256 of every model file, which is slow the first time on large model stores.
+            cls._instance.MODEL_INDEX_PATH = Path(os.getenv("MODEL_INDEX_PATH", project_root / ".cache" / "model_index.json"))
+            cls._instance.MODEL_INDEX_REFRESH_INTERVAL = float(os.getenv("MODEL_INDEX_REFRESH_INTERVAL", 30))
+            cls._instance.MODEL_INDEX_HASH = os.getenv("MODEL_INDEX_HASH", "false").lower() in ("1", "true", "yes")
+
+            # --- Output ---
+            # "file": ComfyUI's SaveImage nodes write PNGs to its output directory. "websocket": they
+            # are swapped for SaveImageWebsocket and the images arrive as bytes on the worker's
+            # WebSocket, so ComfyUI writes no file.
+            cls._instance.OUTPUT_MODE = os.getenv("OUTPUT_MODE", "file").lower()
+
+            # --- Result Storage ---
+            # Where finished images are kept and served from (see src/result_storage.py):
+            #   "local":      where they were produced, so the API must share the worker's disk
+            #   "filesystem": copied into RESULT_STORAGE_PATH, e.g. a mount shared by all nodes
+            #   "redis":      in Redis for RESULT_IMAGE_TTL seconds
+            #   "s3":         in RESULT_S3_BUCKET (or any S3-compatible store at RESULT_S3_ENDPOINT_URL)
+            # The default is "redis" in websocket output mode and "local" otherwise. With
+            # RESULT_DOWNLOAD_MODE="redirect", downloads from S3 are redirected to a presigned URL
+            # valid for RESULT_URL_TTL seconds; everything else is streamed through the API.
+            cls._instance.RESULT_STORAGE = os.getenv("RESULT_STORAGE", "").lower() or ("redis" if cls._instance.OUTPUT_MODE == "websocket" else "local")
+            cls._instance.RESULT_STORAGE_PATH = Path(os.getenv("RESULT_STORAGE_PATH", project_root / "results"))
+            cls._instance.RESULT_IMAGE_TTL = int(os.getenv("RESULT_IMAGE_TTL", 86400))
+            cls._instance.RESULT_DOWNLOAD_MODE = os.getenv("RESULT_DOWNLOAD_MODE", "redirect").lower()
+            cls._instance.RESULT_URL_TTL = int(os.getenv("RESULT_URL_TTL", 3600))
+            cls._instance.RESULT_S3_BUCKET = os.getenv("RESULT_S3_BUCKET", "")
+            cls._instance.RESULT_S3_PREFIX = os.getenv("RESULT_S3_PREFIX", "results/")
+            cls._instance.RESULT_S3_ENDPOINT_URL = os.getenv("RESULT_S3_ENDPOINT_URL") or None
+            cls._instance.RESULT_S3_REGION = os.getenv("RESULT_S3_REGION") or None
+            # Uploads larger than this are sent as multipart uploads, in parts of this size.
+            cls._instance.RESULT_S3_MULTIPART_THRESHOLD = int(os.getenv("RESULT_S3_MULTIPART_THRESHOLD", 8 * 1024 * 1024))
+
+            # --- Result Cache ---
+            # Deterministic requests (fixed seed) are answered from previously rendered results.
+            cls._instance.RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+            cls._instance.RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 86400))
+            cls._instance.RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 10000))
+
+            # --- Request Deduplication ---
+            # How long an Idempotency-Key stays bound to its task, and how long an
+            # in-flight request is remembered for coalescing identical requests (seconds).
+            cls._instance.IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 86400))
+            cls._instance.INFLIGHT_TTL = int(os.getenv("INFLIGHT_TTL", 3600))
+
             # --- Logging Settings ---
             cls._instance.LOG_LEVEL = os.getenv("LOG_LEVEL", "info").lower()
-            cls._instance.AVAILABLE_MODELS: List[str] = []
-            cls._instance.AVAILABLE_LORAS: List[str] = []
+            cls._instance.AVAILABLE_MODELS: Set[str] = set()
+            cls._instance.AVAILABLE_LORAS: Set[str] = set()
+            # Node classes offered by live workers. Empty means unknown, and is not checked.
+            cls._instance.AVAILABLE_NODE_CLASSES: Set[str] = set()
+            # Model file name -> "size:mtime_ns", used to tell when a model file was replaced.
+            cls._instance.MODEL_IDENTITIES: Dict[str, str] = {}
+            cls._instance.model_index: Optional[ModelIndex] = None
 
         return cls._instance
 
+    @property
+    def comfyui_backend_count(self) -> int:
+        return (len(self.COMFYUI_LOCAL_DEVICES) or self.COMFYUI_LOCAL_BACKENDS) + len(self.COMFYUI_REMOTE_URLS)
+
     def initialize(self):
         """
-        Performs one-time setup for ComfyUI paths and scans for available models.
+        Performs one-time setup of model discovery.
         This must be called before the application starts accepting requests.
         """
         if self.initialized:
             return
 
-        print("Initializing application configuration: setting and scanning model paths...")
-
-        folder_paths.base_path = str(project_root)
-        
-        output_directory = comfyui_path / "output"
-        input_directory = comfyui_path / "input"
-        temp_directory = comfyui_path / "temp"
-        
-        output_directory.mkdir(exist_ok=True)
-        input_directory.mkdir(exist_ok=True)
-        temp_directory.mkdir(exist_ok=True)
-
-        folder_paths.set_output_directory(str(output_directory))
-        folder_paths.set_input_directory(str(input_directory))
-        folder_paths.set_temp_directory(str(temp_directory))
-
-        # Scan for models using a whitelist of valid file extensions.
-        VALID_MODEL_EXTENSIONS = {".safetensors", ".ckpt", ".pt", ".pth", ".bin", ".gguf"}
-        model_dirs_to_scan = [comfyui_path / "models" / "checkpoints", comfyui_path / "models" / "unet"]
-        
-        all_models = set()
-        for model_dir in model_dirs_to_scan:
-            if not model_dir.is_dir():
-                continue
-            for filepath in model_dir.rglob('*'):
-                # Condition: it's a file, its extension is in our whitelist, and it's not a hidden file.
-                if filepath.is_file() and filepath.suffix.lower() in VALID_MODEL_EXTENSIONS and not filepath.name.startswith('.'):
-                    all_models.add(filepath.name)
-        
-        self.AVAILABLE_MODELS = sorted(list(all_models))
-
-        # Scan for LoRAs using ComfyUI's built-in function, which handles extensions correctly.
-        lora_dirs = ["loras"]
-        all_loras = set()
-        for dir_type in lora_dirs:
-            try:
-                # get_filename_list already filters by extension correctly.
-                all_loras.update(folder_paths.get_filename_list(dir_type))
-            except Exception as e:
-                print(f"Warning: Could not read LoRAs from '{dir_type}' directory: {e}")
-
-        if "None" not in all_loras:
-            all_loras.add("None")
-        self.AVAILABLE_LORAS = sorted(list(all_loras))
-        
+        print("Initializing application configuration: discovering models...")
+
+        if self.MODEL_DISCOVERY == "registry":
+            print("Model discovery: using the worker capability registry. Models and LoRAs are reported by live workers.")
+            self.initialized = True
+            return
+
+        self.model_index = ModelIndex(comfyui_path / "models", self.MODEL_INDEX_PATH, hash_contents=self.MODEL_INDEX_HASH)
+        if self.model_index.load():
+            print(f"Loaded the model index from {self.MODEL_INDEX_PATH}.")
+        else:
+            print("No model index found; scanning the model directories...")
+        self.refresh_models()
+
         print(f"Scan complete. Found {len(self.AVAILABLE_MODELS)} models and {len(self.AVAILABLE_LORAS)} LoRAs.")
         if not self.AVAILABLE_MODELS:
             print("CRITICAL WARNING: No models found. Check your model directories.")
         else:
-            print(f"Available models found: {self.AVAILABLE_MODELS}")
+            print(f"Available models found: {sorted(self.AVAILABLE_MODELS)}")
 
         self.initialized = True
 
+    def refresh_models(self) -> bool:
+        """
+        Brings the model index up to date with the disk and republishes the
+        available models and LoRAs. Returns True if anything changed.
+        """
+        changed = self.model_index.refresh()
+        if changed:
+            self.model_index.save()
+
+        self.AVAILABLE_MODELS = self.model_index.names("models")
+        self.AVAILABLE_LORAS = self.model_index.names("loras") | {"None"}
+        self.MODEL_IDENTITIES = self.model_index.identities("models")
+        return changed
+
 # Global singleton instance for easy access across the application.
 app_config = AppConfig()
\ No newline at end of file
@@ -0,0 +1,136 @@
+# src/estimates.py
+
+import json
+import logging
+from typing import Any, Dict, List, Optional
+
+from celery import states
+
+from .celery_app import celery_app
+from .config import app_config
+from .redis_client import get_async_redis, get_sync_redis
+from .scheduling import priority_queue, priority_queues
+from .throughput import completion_rate
+
+logger = logging.getLogger(__name__)
+
+# Hash of estimate key -> exponentially weighted moving average of seconds per work unit.
+ESTIMATES_KEY = "comfy:estimates"
+# Per task: the queue and priority it was sent with, its tenant and how to estimate its duration, stored at enqueue.
+TASK_ROUTE_PREFIX = "comfy:task-route:"
+
+# Folds one observation into the moving average: KEYS[1] hash, ARGV[1] field, ARGV[2] value, ARGV[3] alpha.
+_EWMA_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+local value = tonumber(ARGV[2])
+if current then
+    value = tonumber(current) + tonumber(ARGV[3]) * (value - tonumber(current))
+end
+redis.call('HSET', KEYS[1], ARGV[1], tostring(value))
+return tostring(value)
+"""
+
+# Finds a task's message among the last ARGV[2] entries of a Kombu queue (KEYS[1]).
+# Kombu pushes on the left and pops on the right, so position 0 is consumed next.
+# Returns {position, length}; position is -1 if the task was not found.
+_POSITION_SCRIPT = """
+local length = redis.call('LLEN', KEYS[1])
+local items = redis.call('LRANGE', KEYS[1], math.max(length - tonumber(ARGV[2]), 0), -1)
+for i = #items, 1, -1 do
+    if string.find(items[i], ARGV[1], 1, true) then
+        return {#items - i, length}
+    end
+end
+return {-1, length}
+"""
+
+def estimate_keys(workflow_id: str, params: Dict[str, Any]) -> tuple:
+    """The per-resolution key for a job, and its per-workflow fallback."""
+    return f"{workflow_id}:{params.get('width')}x{params.get('height')}", f"{workflow_id}:*"
+
+def work_units(params: Dict[str, Any]) -> float:
+    """A job's size relative to others of the same workflow and resolution: sampling steps × images."""
+    return float(params.get("steps") or 1) * float(params.get("batch_size") or 1)
+
+def record_duration(workflow_id: str, params: Dict[str, Any], seconds: float):
+    """Worker side: feeds how long a job took into the model. Never fails the task."""
+    per_unit = seconds / work_units(params)
+    try:
+        redis = get_sync_redis()
+        for key in estimate_keys(workflow_id, params):
+            redis.eval(_EWMA_SCRIPT, 1, ESTIMATES_KEY, key, per_unit, app_config.ESTIMATE_ALPHA)
+    except Exception as e:
+        logger.warning(f"Could not record the duration of a '{workflow_id}' job: {e}")
+
+async def estimate_duration(workflow_id: str, params: Dict[str, Any]) -> Optional[float]:
+    """Expected execution time of a job in seconds, or None before any similar job has run."""
+    per_unit = None
+    for value in await get_async_redis().hmget(ESTIMATES_KEY, list(estimate_keys(workflow_id, params))):
+        if value is not None:
+            per_unit = float(value)
+            break
+    return per_unit * work_units(params) if per_unit is not None else None
+
+def task_route_key(task_id: str) -> str:
+    return f"{TASK_ROUTE_PREFIX}{task_id}"
+
+async def save_routes(routes: Dict[str, Dict[str, Any]]):
+    """
+    Remembers where tasks were sent ({task_id: {"queue", "priority", "tenant", "workflow_id", "params"}})
+    for as long as their results.
+    """
+    expires = celery_app.backend.expires
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        for task_id, route in routes.items():
+            pipe.set(task_route_key(task_id), json.dumps(route), ex=int(expires) if expires else None)
+        await pipe.execute()
+
+async def load_route(task_id: str) -> Optional[Dict[str, Any]]:
+    raw = await get_async_redis().get(task_route_key(task_id))
+    return json.loads(raw) if raw is not None else None
+
+async def load_routes(task_ids: List[str]) -> List[Optional[Dict[str, Any]]]:
+    """The stored routes of many tasks in one round-trip, in order."""
+    if not task_ids:
+        return []
+    raw_values = await get_async_redis().mget([task_route_key(task_id) for task_id in task_ids])
+    return [json.loads(raw) if raw is not None else None for raw in raw_values]
+
+async def queue_position(queue: str, task_id: str, priority: int = 0) -> Dict[str, Any]:
+    """A task's place in its queue: behind every task of higher priority, and those ahead of it in its own."""
+    redis = get_async_redis()
+    keys = priority_queues(queue)
+    own_key = priority_queue(queue, priority)
+    async with redis.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.llen(key)
+        lengths = dict(zip(keys, await pipe.execute()))
+    position, _ = await redis.eval(_POSITION_SCRIPT, 1, own_key, task_id, app_config.QUEUE_POSITION_SCAN_LIMIT)
+    ahead = sum(lengths[key] for key in keys[:keys.index(own_key)])
+    return {"name": queue, "position": ahead + position if position >= 0 else None, "length": sum(lengths.values())}
+
+async def describe_wait(task_id: str, status: str, result: Any) -> Dict[str, Any]:
+    """
+    Where an unfinished task is waiting and when it should be done: its position in
+    the broker queue or in its ComfyUI backend's queue, and an ETA in seconds.
+    """
+    route = await load_route(task_id)
+    if route is None:
+        return {}
+    duration = await estimate_duration(route["workflow_id"], route["params"])
+    info: Dict[str, Any] = {}
+
+    if status == states.PENDING and isinstance(result, dict) and "backend_position" in result:
+        # Queued inside ComfyUI; the prompts ahead of it are assumed to be of similar size.
+        info["backend_queue"] = {"name": result.get("backend"), "position": result["backend_position"]}
+        if duration is not None:
+            info["eta_seconds"] = round((result["backend_position"] + 1) * duration, 1)
+    elif status == states.PENDING:
+        queue = await queue_position(route["queue"], task_id, route.get("priority") or 0)
+        info["queue"] = queue
+        rate = await completion_rate()
+        if duration is not None and rate and queue["position"] is not None:
+            info["eta_seconds"] = round((queue["position"] + 1) / rate + duration, 1)
+    elif status == "PROGRESS" and isinstance(result, dict) and duration is not None:
+        info["eta_seconds"] = round(duration * (1 - result.get("percent", 0) / 100), 1)
+    return info
@@ -0,0 +1,13 @@
+# src/fingerprint.py
+
+import hashlib
+import json
+from typing import Any
+
+def canonical_json(payload: Any) -> str:
+    """Serializes a payload deterministically: sorted keys, no whitespace."""
+    return json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
+def canonical_digest(payload: Any) -> str:
+    """Returns a SHA-256 hex digest of the payload's canonical JSON form."""
+    return hashlib.sha256(canonical_json(payload).encode("utf-8")).hexdigest()
@@ -0,0 +1,84 @@
+# src/idempotency.py
+
+import json
+from typing import Any, Dict, Optional, Tuple
+
+from celery import states
+
+from .config import app_config
+from .fingerprint import canonical_digest
+from .redis_client import get_async_redis
+from .task_store import fetch_task_meta
+
+IDEMPOTENCY_KEY_PREFIX = "comfy:idempotency:"
+INFLIGHT_KEY_PREFIX = "comfy:inflight:"
+
+# Sets KEYS[1] to ARGV[1] (with a TTL of ARGV[2] seconds) if it is unset or still
+# holds the stale value ARGV[3], and returns whatever value the key ends up with.
+_CLAIM_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if (not current) or current == ARGV[3] then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return ARGV[1]
+end
+return current
+"""
+
+async def _claim(key: str, value: str, ttl: int, stale_value: str = "") -> str:
+    return await get_async_redis().eval(_CLAIM_SCRIPT, 1, key, value, ttl, stale_value)
+
+async def claim_idempotency_key(idempotency_key: str, task_id: str, fingerprint: str) -> Tuple[str, str]:
+    """
+    Binds a client's Idempotency-Key to `task_id` unless it is already bound.
+    Returns the (task_id, request fingerprint) the key is bound to.
+    """
+    key = f"{IDEMPOTENCY_KEY_PREFIX}{canonical_digest(idempotency_key)}"
+    value = json.dumps({"task_id": task_id, "fingerprint": fingerprint})
+    bound = json.loads(await _claim(key, value, app_config.IDEMPOTENCY_TTL))
+    return bound["task_id"], bound["fingerprint"]
+
+async def rebind_idempotency_key(idempotency_key: str, task_id: str, fingerprint: str):
+    """Points an already claimed Idempotency-Key at a different task (e.g. a coalesced one)."""
+    key = f"{IDEMPOTENCY_KEY_PREFIX}{canonical_digest(idempotency_key)}"
+    value = json.dumps({"task_id": task_id, "fingerprint": fingerprint})
+    await get_async_redis().set(key, value, ex=app_config.IDEMPOTENCY_TTL)
+
+async def release_idempotency_key(idempotency_key: str, task_id: str):
+    """Unbinds an Idempotency-Key from `task_id`, e.g. when enqueuing the task failed."""
+    key = f"{IDEMPOTENCY_KEY_PREFIX}{canonical_digest(idempotency_key)}"
+    redis = get_async_redis()
+    raw = await redis.get(key)
+    if raw is not None and json.loads(raw)["task_id"] == task_id:
+        await redis.delete(key)
+
+async def claim_inflight(fingerprint: str, task_id: str) -> str:
+    """
+    Single-flight: registers `task_id` as the in-flight task for a request fingerprint,
+    unless an identical request is still queued or running. Returns the task ID that
+    should serve the request. Finished tasks do not block a new claim.
+    """
+    key = f"{INFLIGHT_KEY_PREFIX}{fingerprint}"
+    winner = await _claim(key, task_id, app_config.INFLIGHT_TTL)
+    if winner == task_id:
+        return task_id
+
+    meta = await fetch_task_meta(winner)
+    if meta["status"] in states.READY_STATES:
+        return await _claim(key, task_id, app_config.INFLIGHT_TTL, stale_value=winner)
+    return winner
+
+async def release_inflight(fingerprint: str, task_id: str):
+    """Removes an in-flight claim, e.g. when enqueuing the task failed."""
+    key = f"{INFLIGHT_KEY_PREFIX}{fingerprint}"
+    redis = get_async_redis()
+    if await redis.get(key) == task_id:
+        await redis.delete(key)
+
+def request_fingerprint(workflow_id: str, params: Dict[str, Any], callback_url: Optional[str]) -> str:
+    """
+    Identifies identical requests by their canonical content as sent by the client.
+    The params must be taken before validation, which replaces `seed: "random"` with
+    a new seed on every call, so that retries of the same request still match
+    their Idempotency-Key. Such requests are never coalesced automatically.
+    """
+    return canonical_digest({"workflow_id": workflow_id, "params": params, "callback_url": callback_url})
@@ -1,35 +1,199 @@
 # src/manifest_loader.py
 
+import logging
+import random
+import threading
+import time
 import yaml
 from pathlib import Path
-from functools import lru_cache
-import random
-from typing import Dict, Any
+from typing import Any, Callable, Dict, List, Optional
 
 from .config import app_config
+from .workflow_utils import workflow_registry
 
 EXPERIMENTAL_WORKFLOW_PREFIX = "exp_"
 MANIFEST_DIR = Path(__file__).parent / "manifests"
+MANIFEST_FILES = ("base.yaml", "workflows.yaml", "loras.yaml")
 
-@lru_cache(maxsize=1)
-def load_manifests():
-    """Loads and caches all YAML manifests from the manifests directory."""
-    with open(MANIFEST_DIR / "base.yaml", 'r') as f:
-        base_manifest = yaml.safe_load(f)
-    with open(MANIFEST_DIR / "workflows.yaml", 'r') as f:
-        workflows_manifest = yaml.safe_load(f)
-    
-    loras_manifest_path = MANIFEST_DIR / "loras.yaml"
-    loras_manifest = {}
-    if loras_manifest_path.is_file():
-        with open(loras_manifest_path, 'r') as f:
-            loras_manifest = yaml.safe_load(f)
-
-    return {
-        "base": base_manifest,
-        "workflows": workflows_manifest,
-        "loras": loras_manifest
-    }
+logger = logging.getLogger(__name__)
+
+# Coerces a raw request value to a base.yaml type. Types without an entry are passed through.
+COERCERS: Dict[str, Callable[[Any], Any]] = {
+    "string": str,
+    "integer": int,
+    "float": float,
+    "boolean": bool,
+}
+
+class ParamValidator:
+    """One parameter of one workflow, with everything from the manifests resolved up front."""
+
+    __slots__ = ("name", "map_to", "param_type", "coerce", "default", "required", "random_seed", "non_negative", "minimum", "maximum", "allowed")
+
+    def __init__(self, name: str, param_info: Dict[str, Any], required: bool):
+        self.name = name
+        self.map_to = param_info.get("map_to", name)
+        self.param_type = param_info.get("type")
+        self.coerce = COERCERS.get(self.param_type)
+        self.default = param_info.get("default")
+        self.required = required
+        self.random_seed = name == "seed"
+        self.non_negative = self.param_type == "integer"
+        self.minimum = param_info.get("min")
+        self.maximum = param_info.get("max")
+        # The files are looked up at validation time, since the available sets change at runtime.
+        self.allowed = {"model": "AVAILABLE_MODELS", "lora": "AVAILABLE_LORAS"}.get(name)
+
+    def validate(self, value: Any) -> Any:
+        if value is None:
+            if self.required:
+                raise ValueError(f"Missing required parameter: '{self.name}'")
+            value = self.default
+
+        if self.random_seed and str(value).lower() == "random":
+            value = random.SystemRandom().randint(0, 2**63 - 1)
+
+        if value is None:
+            return None
+
+        if self.coerce is not None:
+            try:
+                value = self.coerce(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"Parameter '{self.name}' with value '{value}' must be of type {self.param_type}.")
+
+        if self.non_negative and value < 0:
+            raise ValueError(f"Parameter '{self.name}' must be a non-negative integer, but got {value}.")
+        if self.minimum is not None and value < self.minimum:
+            raise ValueError(f"Parameter '{self.name}' must be at least {self.minimum}, but got {value}.")
+        if self.maximum is not None and value > self.maximum:
+            raise ValueError(f"Parameter '{self.name}' must be at most {self.maximum}, but got {value}.")
+
+        if self.allowed == "AVAILABLE_MODELS" and value not in app_config.AVAILABLE_MODELS:
+            raise ValueError(f"Model '{value}' not found.")
+        if self.allowed == "AVAILABLE_LORAS" and value not in app_config.AVAILABLE_LORAS:
+            raise ValueError(f"LoRA '{value}' not found.")
+        return value
+
+class WorkflowValidator:
+    """Validates requests for one workflow. Built once per manifest version, not per request."""
+
+    def __init__(self, workflow_id: str, params: List[ParamValidator]):
+        self.workflow_id = workflow_id
+        self.params = params
+
+    def validate(self, params: Dict[str, Any], lora_manifest: Dict[str, Any]) -> Dict[str, Any]:
+        validated_params = {param.map_to: param.validate(params.get(param.name)) for param in self.params}
+        # Apply LoRA prompt modifiers to the validated parameters
+        return apply_lora_prompt_modifiers(validated_params, lora_manifest)
+
+class ManifestSet:
+    """One version of the parsed manifests and the validators compiled from them."""
+
+    def __init__(self, manifests: Dict[str, Any], mtimes: Dict[str, int]):
+        self.manifests = manifests
+        self.mtimes = mtimes
+        base = manifests["base"]
+
+        self.validators: Dict[str, WorkflowValidator] = {}
+        for workflow_id, workflow_info in manifests["workflows"].items():
+            required = {p for p, o in (workflow_info.get("overrides") or {}).items() if o.get("required")}
+            self.validators[workflow_id] = WorkflowValidator(workflow_id, [
+                ParamValidator(name, base[name], name in required)
+                for name in dict.fromkeys(workflow_info.get("parameters", [])) if name in base
+            ])
+        # For experimental workflows, allow all base parameters
+        self.experimental_params = [ParamValidator(name, info, False) for name, info in base.items()]
+        self._experimental: Dict[str, WorkflowValidator] = {}
+
+    def validator_for(self, workflow_id: str) -> WorkflowValidator:
+        if workflow_id.startswith(EXPERIMENTAL_WORKFLOW_PREFIX):
+            validator = self._experimental.get(workflow_id)
+            if validator is None:
+                if not workflow_registry.path_for(workflow_id).is_file():
+                    raise ValueError(f"Experimental workflow file '{workflow_id}.json' not found in 'src/workflows/'.")
+                validator = self._experimental[workflow_id] = WorkflowValidator(workflow_id, self.experimental_params)
+            return validator
+
+        validator = self.validators.get(workflow_id)
+        if validator is None:
+            raise ValueError(f"Workflow '{workflow_id}' not found in manifest.")
+        return validator
+
+class ManifestRegistry:
+    """
+    Holds the current ManifestSet and replaces it when a manifest file changes.
+
+    The files are checked at most every MANIFEST_RELOAD_INTERVAL seconds. A new
+    set is fully built before it is swapped in, so a request always sees one
+    consistent version; if the new files do not parse, the old set stays in use.
+    """
+
+    def __init__(self, manifest_dir: Path = MANIFEST_DIR):
+        self.manifest_dir = manifest_dir
+        self._current: Optional[ManifestSet] = None
+        self._checked_at = 0.0
+        self._failed_mtimes: Optional[Dict[str, int]] = None
+        self._lock = threading.Lock()
+
+    def _mtimes(self) -> Dict[str, int]:
+        mtimes = {}
+        for name in MANIFEST_FILES:
+            try:
+                mtimes[name] = (self.manifest_dir / name).stat().st_mtime_ns
+            except FileNotFoundError:
+                mtimes[name] = 0
+        return mtimes
+
+    def _load(self, mtimes: Dict[str, int]) -> ManifestSet:
+        with open(self.manifest_dir / "base.yaml", 'r') as f:
+            base_manifest = yaml.safe_load(f)
+        with open(self.manifest_dir / "workflows.yaml", 'r') as f:
+            workflows_manifest = yaml.safe_load(f)
+
+        loras_manifest_path = self.manifest_dir / "loras.yaml"
+        loras_manifest = {}
+        if loras_manifest_path.is_file():
+            with open(loras_manifest_path, 'r') as f:
+                loras_manifest = yaml.safe_load(f) or {}
+
+        return ManifestSet({
+            "base": base_manifest,
+            "workflows": workflows_manifest,
+            "loras": loras_manifest
+        }, mtimes)
+
+    def current(self) -> ManifestSet:
+        current = self._current
+        interval = app_config.MANIFEST_RELOAD_INTERVAL
+        if current is not None and (interval <= 0 or time.monotonic() - self._checked_at < interval):
+            return current
+
+        with self._lock:
+            if self._current is not None and self._current is not current:
+                return self._current
+            self._checked_at = time.monotonic()
+            mtimes = self._mtimes()
+            if current is not None and mtimes in (current.mtimes, self._failed_mtimes):
+                return current
+            try:
+                self._current = self._load(mtimes)
+            except Exception as e:
+                if current is None:
+                    raise
+                self._failed_mtimes = mtimes
+                logger.error(f"Could not reload manifests, keeping the previous version: {e}")
+                return current
+            if current is not None:
+                logger.info(f"Reloaded manifests ({len(self._current.validators)} workflows, {len(self._current.manifests['loras'])} LoRAs).")
+            return self._current
+
+# Global registry instance, one per process.
+manifest_registry = ManifestRegistry()
+
+def load_manifests() -> Dict[str, Any]:
+    """Returns the current version of all YAML manifests from the manifests directory."""
+    return manifest_registry.current().manifests
 
 def apply_lora_prompt_modifiers(params: Dict[str, Any], lora_manifest: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -67,6 +231,16 @@ def apply_lora_prompt_modifiers(params: Dict[str, Any], lora_manifest: Dict[str,
 
     return params
 
+def uses_random_seed(params: Dict[str, Any]) -> bool:
+    """
+    True if the request leaves its seed to the random generator in `validate_request`,
+    i.e. its output is not reproducible from the request alone.
+    """
+    seed = params.get("seed")
+    if seed is None:
+        seed = load_manifests()["base"].get("seed", {}).get("default")
+    return str(seed).lower() == "random"
+
 def validate_request(workflow_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
     """
     Validates a request, supports exp_* workflows, and applies LoRA modifiers.
@@ -74,66 +248,17 @@ def validate_request(workflow_id: str, params: Dict[str, Any]) -> Dict[str, Any]
     if not app_config.initialized:
         raise RuntimeError("Application config not initialized. Run the app via main.py.")
 
-    manifests = load_manifests()
-    base_params_info = manifests["base"]
-    workflows = manifests["workflows"]
-    
-    allowed_params = set()
-    is_experimental = workflow_id.startswith(EXPERIMENTAL_WORKFLOW_PREFIX)
-    if is_experimental:
-        workflow_file_path = Path(__file__).parent / "workflows" / f"{workflow_id}.json"
-        if not workflow_file_path.is_file():
-            raise ValueError(f"Experimental workflow file '{workflow_id}.json' not found in 'src/workflows/'.")
-        # For experimental workflows, allow all base parameters
-        allowed_params = set(base_params_info.keys())
-        is_required_map = {}
-    else:
-        if workflow_id not in workflows:
-            raise ValueError(f"Workflow '{workflow_id}' not found in manifest.")
-        workflow_info = workflows[workflow_id]
-        allowed_params = set(workflow_info.get("parameters", []))
-        is_required_map = {p: True for p, o in workflow_info.get("overrides", {}).items() if o.get("required")}
-
-    validated_params = {}
-
-    # First, validate and collect all parameters as usual
-    for param_name in allowed_params:
-        if param_name not in base_params_info:
-            continue
-        param_info = base_params_info[param_name]
-        is_required = is_required_map.get(param_name, False)
-        value = params.get(param_name)
-        
-        if is_required and value is None:
-            raise ValueError(f"Missing required parameter: '{param_name}'")
-        if value is None:
-            value = param_info.get("default")
-        
-        if param_name == "seed" and str(value).lower() == "random":
-            value = random.SystemRandom().randint(0, 2**63 - 1)
-        
-        param_type = param_info.get("type")
-        try:
-            if value is not None:
-                if param_type == "string": value = str(value)
-                elif param_type == "integer": value = int(value)
-                elif param_type == "float": value = float(value)
-                elif param_type == "boolean": value = bool(value)
-        except (TypeError, ValueError):
-            raise ValueError(f"Parameter '{param_name}' with value '{value}' must be of type {param_type}.")
-        
-        if param_type == "integer" and value is not None and value < 0:
-            raise ValueError(f"Parameter '{param_name}' must be a non-negative integer, but got {value}.")
-        
-        if param_name == "model" and value not in app_config.AVAILABLE_MODELS:
-            raise ValueError(f"Model '{value}' not found.")
-        if param_name == "lora" and value not in app_config.AVAILABLE_LORAS:
-            raise ValueError(f"LoRA '{value}' not found.")
-        
-        map_to_key = param_info.get("map_to", param_name)
-        validated_params[map_to_key] = value
-    
-    # Apply LoRA prompt modifiers to the validated parameters
-    validated_params = apply_lora_prompt_modifiers(validated_params, manifests["loras"])
-        
-    return validated_params
\ No newline at end of file
+    manifest_set = manifest_registry.current()
+    validator = manifest_set.validator_for(workflow_id)
+
+    try:
+        template = workflow_registry.get(workflow_id)
+    except FileNotFoundError:
+        raise ValueError(f"Workflow '{workflow_id}' is in the manifest, but its workflow file is missing on the server.")
+
+    if app_config.AVAILABLE_NODE_CLASSES:
+        missing_classes = template.required_class_types(app_config.OUTPUT_MODE == "websocket") - app_config.AVAILABLE_NODE_CLASSES
+        if missing_classes:
+            raise ValueError(f"Workflow '{workflow_id}' needs node types no live worker provides: {', '.join(sorted(missing_classes))}.")
+
+    return validator.validate(params, manifest_set.manifests["loras"])
@@ -0,0 +1,21 @@
+# src/metrics.py
+
+import logging
+from typing import Dict
+
+from .redis_client import get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY = "comfy:metrics"
+
+def incr(name: str, amount: int = 1):
+    """Increments a shared counter. Metrics must never fail a task, so errors are only logged."""
+    try:
+        get_sync_redis().hincrby(METRICS_KEY, name, amount)
+    except Exception as e:
+        logger.warning(f"Could not record metric '{name}': {e}")
+
+def read_all() -> Dict[str, int]:
+    """Returns all counters recorded by the workers."""
+    return {name: int(value) for name, value in get_sync_redis().hgetall(METRICS_KEY).items()}
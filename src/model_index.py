@@ -0,0 +1,170 @@
+# src/model_index.py
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+
+MODEL_EXTENSIONS = {".safetensors", ".ckpt", ".pt", ".pth", ".bin", ".gguf"}
+# The extensions ComfyUI's folder_paths accepts for LoRAs.
+LORA_EXTENSIONS = {".ckpt", ".pt", ".pt2", ".bin", ".pth", ".safetensors", ".pkl", ".sft"}
+
+# Category -> model subdirectories, accepted extensions, and whether files are named
+# by their path relative to the directory (as ComfyUI lists LoRAs) or by file name only.
+CATEGORIES: Dict[str, Dict[str, Any]] = {
+    "models": {"dirs": ["checkpoints", "unet"], "extensions": MODEL_EXTENSIONS, "relative_names": False},
+    "loras": {"dirs": ["loras"], "extensions": LORA_EXTENSIONS, "relative_names": True},
+}
+
+class ModelIndex:
+    """
+    A persisted index of the model files under a ComfyUI `models` directory.
+
+    Each file is recorded with its size, mtime and (optionally) a SHA-256 of its
+    contents. The index loads instantly from its JSON file, and `refresh` only
+    re-lists directories whose mtime changed since the last refresh, so after
+    the first scan a refresh costs one stat per directory. Files added, removed
+    or replaced (renamed over) are picked up; a file rewritten in place is not.
+    """
+
+    def __init__(self, models_dir: Path, index_path: Path, hash_contents: bool = False):
+        self.models_dir = models_dir
+        self.index_path = index_path
+        self.hash_contents = hash_contents
+        # Directory path -> {"mtime_ns", "subdirs", "files"}
+        self.dirs: Dict[str, Dict[str, Any]] = {}
+        # File path -> {"category", "name", "size", "mtime_ns", "sha256"}
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> bool:
+        """Loads the persisted index. Returns False if there was none (or it was unusable)."""
+        try:
+            with open(self.index_path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable model index {self.index_path}: {e}")
+            return False
+
+        if data.get("version") != INDEX_VERSION or data.get("models_dir") != str(self.models_dir):
+            return False
+        self.dirs, self.files = data["dirs"], data["files"]
+        return True
+
+    def save(self):
+        """Writes the index atomically, so concurrent readers never see a partial file."""
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_suffix(f".{os.getpid()}.tmp")
+        with self._lock:
+            data = {"version": INDEX_VERSION, "models_dir": str(self.models_dir), "dirs": self.dirs, "files": self.files}
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+        os.replace(tmp_path, self.index_path)
+
+    def refresh(self) -> bool:
+        """Brings the index up to date with the disk. Returns True if anything changed."""
+        with self._lock:
+            changed = False
+            seen_dirs: Set[str] = set()
+            stack = [
+                (str(self.models_dir / subdir), category, str(self.models_dir / subdir))
+                for category, spec in CATEGORIES.items() for subdir in spec["dirs"]
+            ]
+
+            while stack:
+                directory, category, root = stack.pop()
+                try:
+                    mtime_ns = os.stat(directory).st_mtime_ns
+                except OSError:
+                    continue
+                seen_dirs.add(directory)
+
+                known = self.dirs.get(directory)
+                if known is not None and known["mtime_ns"] == mtime_ns:
+                    stack.extend((subdir, category, root) for subdir in known["subdirs"])
+                    continue
+
+                subdirs, files = self._rescan_directory(directory, category, root)
+                self.dirs[directory] = {"mtime_ns": mtime_ns, "subdirs": subdirs, "files": files}
+                stack.extend((subdir, category, root) for subdir in subdirs)
+                changed = True
+
+            for directory in set(self.dirs) - seen_dirs:
+                for path in self.dirs.pop(directory)["files"]:
+                    self.files.pop(path, None)
+                changed = True
+
+            return changed
+
+    def _rescan_directory(self, directory: str, category: str, root: str):
+        spec = CATEGORIES[category]
+        subdirs: List[str] = []
+        files: List[str] = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir():
+                        subdirs.append(entry.path)
+                    elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in spec["extensions"]:
+                        files.append(entry.path)
+                        self._update_file(entry.path, category, root)
+        except OSError as e:
+            logger.warning(f"Could not list model directory {directory}: {e}")
+
+        previous = self.dirs.get(directory, {}).get("files", [])
+        for path in set(previous) - set(files):
+            self.files.pop(path, None)
+        return subdirs, files
+
+    def _update_file(self, path: str, category: str, root: str):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        entry = self.files.get(path)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return
+
+        if CATEGORIES[category]["relative_names"]:
+            name = os.path.relpath(path, root).replace(os.sep, "/")
+        else:
+            name = os.path.basename(path)
+        self.files[path] = {
+            "category": category,
+            "name": name,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": file_sha256(path) if self.hash_contents else None,
+        }
+
+    def names(self, category: str) -> Set[str]:
+        return {entry["name"] for entry in self.files.values() if entry["category"] == category}
+
+    def identities(self, category: str) -> Dict[str, str]:
+        """File name -> a string that changes whenever the file's contents may have changed."""
+        return {
+            entry["name"]: entry["sha256"] or f"{entry['size']}:{entry['mtime_ns']}"
+            for entry in self.files.values() if entry["category"] == category
+        }
+
+def file_sha256(path: str, chunk_size: int = 8 * 1024 * 1024) -> Optional[str]:
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+    except OSError as e:
+        logger.warning(f"Could not hash model file {path}: {e}")
+        return None
+    return digest.hexdigest()
@@ -0,0 +1,94 @@
+# src/progress.py
+
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from celery.app.task import Task
+
+from .config import app_config
+
+logger = logging.getLogger(__name__)
+
+class ProgressPublisher:
+    """
+    Coalesces a task's state updates and writes them to the result backend
+    from a background coroutine, so the WebSocket receive loop never waits on Redis.
+
+    An update is written when the state changes, when progress moves by at least
+    `min_delta` percent or reaches 100%, and never more often than `min_interval`
+    seconds. Updates in between are folded into the latest one. `close` always
+    writes whatever is still pending.
+    """
+
+    def __init__(self, task: Task, task_id: str, min_interval: Optional[float] = None, min_delta: Optional[float] = None):
+        self.task = task
+        self.task_id = task_id
+        self.min_interval = app_config.PROGRESS_MIN_INTERVAL if min_interval is None else min_interval
+        self.min_delta = app_config.PROGRESS_MIN_PERCENT_DELTA if min_delta is None else min_delta
+
+        self._pending: Optional[Tuple[str, Dict[str, Any]]] = None
+        self._last_state: Optional[str] = None
+        self._last_percent: Optional[float] = None
+        self._last_sent_at = float("-inf")
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._runner: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._runner = asyncio.create_task(self._run())
+
+    def publish(self, state: str, meta: Dict[str, Any]):
+        """Records the latest state. Never blocks."""
+        self._pending = (state, meta)
+
+        percent = meta.get('percent')
+        significant = (
+            state != self._last_state
+            or percent is None
+            or self._last_percent is None
+            or percent >= 100
+            or abs(percent - self._last_percent) >= self.min_delta
+        )
+        if significant:
+            self._wakeup.set()
+
+    async def close(self):
+        """Stops the publisher after writing any pending update."""
+        self._closing = True
+        self._wakeup.set()
+        if self._runner is not None:
+            await self._runner
+        else:
+            await self._flush()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._closing:
+                await self._wakeup.wait()
+            # Hold the update back until `min_interval` has passed, unless `close` cuts the wait short.
+            delay = self._last_sent_at + self.min_interval - loop.time()
+            while delay > 0 and not self._closing:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    break
+                delay = self._last_sent_at + self.min_interval - loop.time()
+            self._wakeup.clear()
+            await self._flush()
+            if self._closing and self._pending is None:
+                return
+
+    async def _flush(self):
+        if self._pending is None:
+            return
+        state, meta = self._pending
+        self._pending = None
+        self._last_state, self._last_percent = state, meta.get('percent')
+        self._last_sent_at = asyncio.get_running_loop().time()
+        try:
+            await asyncio.to_thread(self.task.update_state, task_id=self.task_id, state=state, meta=meta)
+        except Exception as e:
+            logger.warning(f"[{self.task_id}] Could not publish {state} state: {e}")
@@ -0,0 +1,50 @@
+# src/redis_client.py
+
+from typing import Optional
+
+import redis
+import redis.asyncio as redis_async
+
+from .config import app_config
+
+_sync_client: Optional[redis.Redis] = None
+
+def get_sync_redis() -> redis.Redis:
+    """
+    Returns a process-wide Redis client for the service's own keys.
+    It talks to the same Redis instance Celery uses as its result backend.
+    """
+    global _sync_client
+    if _sync_client is None:
+        _sync_client = redis.Redis.from_url(app_config.CELERY_BACKEND_URL, decode_responses=True)
+    return _sync_client
+
+_async_client: Optional[redis_async.Redis] = None
+
+def get_async_redis() -> redis_async.Redis:
+    """
+    Returns the asyncio Redis client for the API's event loop.
+    It must only be used from the loop that first called this function.
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = redis_async.Redis.from_url(app_config.CELERY_BACKEND_URL, decode_responses=True)
+    return _async_client
+
+_sync_binary_client: Optional[redis.Redis] = None
+
+def get_sync_binary_redis() -> redis.Redis:
+    """Like `get_sync_redis`, but for keys holding binary data (values are returned as bytes)."""
+    global _sync_binary_client
+    if _sync_binary_client is None:
+        _sync_binary_client = redis.Redis.from_url(app_config.CELERY_BACKEND_URL)
+    return _sync_binary_client
+
+_async_binary_client: Optional[redis_async.Redis] = None
+
+def get_async_binary_redis() -> redis_async.Redis:
+    """Like `get_async_redis`, but for keys holding binary data (values are returned as bytes)."""
+    global _async_binary_client
+    if _async_binary_client is None:
+        _async_binary_client = redis_async.Redis.from_url(app_config.CELERY_BACKEND_URL)
+    return _async_binary_client
@@ -0,0 +1,90 @@
+# src/result_cache.py
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+from celery import states
+
+from .celery_app import celery_app
+from .config import app_config
+from .fingerprint import canonical_digest
+from .result_storage import storage_for
+from .redis_client import get_async_redis, get_sync_redis
+from .workflow_utils import workflow_registry
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY_PREFIX = "comfy:result-cache:"
+# Sorted set of cache keys scored by insertion time, used for size-based eviction.
+CACHE_INDEX_KEY = "comfy:result-cache-index"
+
+def compute_cache_key(workflow_id: str, validated_params: Dict[str, Any]) -> str:
+    """
+    Returns the content address of a request: a hash of everything that
+    determines its output. The caller must skip requests with a random seed.
+    """
+    model = validated_params.get("model")
+    return canonical_digest({
+        "workflow_id": workflow_id,
+        "params": validated_params,
+        "model_identity": app_config.MODEL_IDENTITIES.get(model) if model else None,
+        "template": workflow_registry.get(workflow_id).digest,
+    })
+
+async def lookup(cache_key: str) -> Optional[Dict[str, Any]]:
+    """
+    Returns the cached task result for a content address, or None.
+    Entries whose images have disappeared from the result storage are dropped.
+    """
+    redis = get_async_redis()
+    raw = await redis.get(f"{CACHE_KEY_PREFIX}{cache_key}")
+    if raw is None:
+        return None
+
+    result = json.loads(raw)
+    file_paths = result.get("file_paths") or [result.get("file_path")]
+    exists = [bool(path) and await storage_for(path).exists(path) for path in file_paths]
+    if not all(exists):
+        logger.info(f"Result cache entry {cache_key[:12]} points at missing files. Dropping it.")
+        await redis.delete(f"{CACHE_KEY_PREFIX}{cache_key}")
+        await redis.zrem(CACHE_INDEX_KEY, cache_key)
+        return None
+    return result
+
+async def replay(result: Dict[str, Any], task_id: Optional[str] = None) -> str:
+    """
+    Creates an already-completed task carrying a cached result and returns its ID,
+    so that clients can treat a cache hit like any other finished task.
+    """
+    task_id = task_id or str(uuid.uuid4())
+    await asyncio.to_thread(celery_app.backend.store_result, task_id, result, states.SUCCESS)
+    return task_id
+
+def store(cache_key: str, result: Dict[str, Any]):
+    """
+    Records a finished task's result under its content address (worker side).
+    Entries expire after RESULT_CACHE_TTL; the oldest are evicted beyond RESULT_CACHE_MAX_ENTRIES.
+    """
+    redis = get_sync_redis()
+    now = time.time()
+    try:
+        with redis.pipeline() as pipe:
+            pipe.set(f"{CACHE_KEY_PREFIX}{cache_key}", json.dumps(result), ex=app_config.RESULT_CACHE_TTL)
+            pipe.zadd(CACHE_INDEX_KEY, {cache_key: now})
+            pipe.zremrangebyscore(CACHE_INDEX_KEY, "-inf", now - app_config.RESULT_CACHE_TTL)
+            pipe.execute()
+
+        overflow = redis.zcard(CACHE_INDEX_KEY) - app_config.RESULT_CACHE_MAX_ENTRIES
+        if overflow > 0:
+            evicted = redis.zrange(CACHE_INDEX_KEY, 0, overflow - 1)
+            with redis.pipeline() as pipe:
+                pipe.delete(*(f"{CACHE_KEY_PREFIX}{key}" for key in evicted))
+                pipe.zrem(CACHE_INDEX_KEY, *evicted)
+                pipe.execute()
+    except Exception as e:
+        # The cache is an optimization; a failure here must not fail the task.
+        logger.warning(f"Could not store result cache entry {cache_key[:12]}: {e}")
@@ -0,0 +1,293 @@
+# src/result_storage.py
+
+import asyncio
+import errno
+import io
+import logging
+import os
+import shutil
+import threading
+import uuid
+from pathlib import Path
+from typing import AsyncIterator, Dict, Optional
+
+from .config import app_config, comfyui_path
+from .redis_client import get_async_binary_redis, get_sync_binary_redis
+
+logger = logging.getLogger(__name__)
+
+# Chunk size for streaming stored images through the API.
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+MEDIA_TYPES = {"png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+def media_type(filename: str) -> str:
+    return MEDIA_TYPES.get(filename.rsplit(".", 1)[-1].lower(), "application/octet-stream")
+
+class ResultStorage:
+    """
+    Where finished images are kept and served from.
+
+    Workers save each image and record the location it returns in the task result
+    (under `file_paths`, in place of a path). Locations start with the storage's
+    `prefix`, so the API can serve any result, whichever storage stored it.
+    """
+
+    prefix = ""
+
+    def key(self, location: str) -> str:
+        return location[len(self.prefix):]
+
+    def save_file(self, task_id: str, path: str) -> str:
+        """Worker side: stores an image file and returns its location. Blocking."""
+        with open(path, "rb") as f:
+            return self.save_stream(task_id, os.path.basename(path), f)
+
+    def save_bytes(self, task_id: str, filename: str, data: bytes) -> str:
+        """Worker side: stores an image received in memory and returns its location. Blocking."""
+        return self.save_stream(task_id, filename, io.BytesIO(data))
+
+    def save_stream(self, task_id: str, filename: str, stream) -> str:
+        raise NotImplementedError
+
+    def delete(self, location: str):
+        """Removes a stored image, if it is still there. Blocking."""
+        raise NotImplementedError
+
+    async def exists(self, location: str) -> bool:
+        raise NotImplementedError
+
+    def local_path(self, location: str) -> Optional[str]:
+        """A path the API can serve the image from directly, if the storage is a filesystem."""
+        return None
+
+    async def download_url(self, location: str, filename: str) -> Optional[str]:
+        """A URL clients can be redirected to, if the storage can serve the image itself."""
+        return None
+
+    def stream(self, location: str) -> AsyncIterator[bytes]:
+        """The image's bytes in chunks, for storages without a `local_path`."""
+        raise NotImplementedError
+
+class LocalStorage(ResultStorage):
+    """
+    Images stay where they were produced (ComfyUI's output directory), and
+    locations are plain paths. The API must run on the same disk as the workers.
+    """
+
+    def __init__(self, root: Optional[Path] = None):
+        self.root = root or comfyui_path / "output"
+
+    def save_file(self, task_id: str, path: str) -> str:
+        return path
+
+    def save_stream(self, task_id: str, filename: str, stream) -> str:
+        path = self.root / filename
+        write_atomically(path, stream)
+        return str(path)
+
+    def delete(self, location: str):
+        Path(location).unlink(missing_ok=True)
+
+    async def exists(self, location: str) -> bool:
+        return os.path.exists(location)
+
+    def local_path(self, location: str) -> Optional[str]:
+        return location
+
+class FilesystemStorage(ResultStorage):
+    """
+    Images are moved into a directory tree, one directory per task. Point
+    RESULT_STORAGE_PATH at a mount shared by all nodes; it also stands in for an
+    object store in tests and single-machine setups.
+    """
+
+    prefix = "fs://"
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def path(self, location: str) -> Path:
+        key = self.key(location)
+        path = (self.root / key).resolve()
+        if self.root.resolve() not in path.parents:
+            raise ValueError(f"Location '{location}' is outside the result storage.")
+        return path
+
+    def save_file(self, task_id: str, path: str) -> str:
+        """Moves the file out of ComfyUI's output directory, so it is not kept twice."""
+        location = f"{self.prefix}{task_id}/{os.path.basename(path)}"
+        target = self.path(location)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.replace(path, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # RESULT_STORAGE_PATH is on another filesystem (e.g. a network mount).
+            with open(path, "rb") as f:
+                write_atomically(target, f)
+            os.unlink(path)
+        return location
+
+    def save_stream(self, task_id: str, filename: str, stream) -> str:
+        location = f"{self.prefix}{task_id}/{filename}"
+        write_atomically(self.path(location), stream)
+        return location
+
+    def delete(self, location: str):
+        path = self.path(location)
+        path.unlink(missing_ok=True)
+        try:
+            path.parent.rmdir()
+        except OSError:
+            pass  # Other images of the task are still there.
+
+    async def exists(self, location: str) -> bool:
+        return await asyncio.to_thread(self.path(location).is_file)
+
+    def local_path(self, location: str) -> Optional[str]:
+        return str(self.path(location))
+
+class RedisStorage(ResultStorage):
+    """Images are kept in Redis for RESULT_IMAGE_TTL seconds. No disk is involved."""
+
+    prefix = "redis-image://"
+    key_prefix = "comfy:image:"
+
+    def save_stream(self, task_id: str, filename: str, stream) -> str:
+        location = f"{self.prefix}{task_id}/{filename}"
+        get_sync_binary_redis().set(self.redis_key(location), stream.read(), ex=app_config.RESULT_IMAGE_TTL)
+        return location
+
+    def redis_key(self, location: str) -> str:
+        return f"{self.key_prefix}{self.key(location)}"
+
+    def delete(self, location: str):
+        get_sync_binary_redis().delete(self.redis_key(location))
+
+    async def exists(self, location: str) -> bool:
+        return bool(await get_async_binary_redis().exists(self.redis_key(location)))
+
+    async def stream(self, location: str) -> AsyncIterator[bytes]:
+        data = await get_async_binary_redis().get(self.redis_key(location))
+        if data is not None:
+            yield data
+
+class S3Storage(ResultStorage):
+    """
+    Images are uploaded to an S3 bucket (or an S3-compatible store such as MinIO),
+    as multipart uploads when they are large. Needs the optional `boto3` package;
+    credentials come from the usual AWS environment variables or config files.
+    """
+
+    prefix = "s3://"
+
+    def __init__(self, bucket: str, key_prefix: str = "", endpoint_url: Optional[str] = None, region: Optional[str] = None):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.exceptions import ClientError
+        except ImportError as e:
+            raise RuntimeError("RESULT_STORAGE=\"s3\" needs the boto3 package (pip install boto3).") from e
+        if not bucket:
+            raise RuntimeError("RESULT_STORAGE=\"s3\" needs RESULT_S3_BUCKET.")
+        self.bucket = bucket
+        self.key_prefix = key_prefix
+        self.client_error = ClientError
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        threshold = app_config.RESULT_S3_MULTIPART_THRESHOLD
+        self.transfer_config = TransferConfig(multipart_threshold=threshold, multipart_chunksize=threshold)
+
+    def split(self, location: str):
+        bucket, _, key = self.key(location).partition("/")
+        return bucket, key
+
+    def save_stream(self, task_id: str, filename: str, stream) -> str:
+        key = f"{self.key_prefix}{task_id}/{filename}"
+        self.client.upload_fileobj(
+            stream, self.bucket, key,
+            ExtraArgs={"ContentType": media_type(filename)}, Config=self.transfer_config,
+        )
+        return f"{self.prefix}{self.bucket}/{key}"
+
+    def delete(self, location: str):
+        bucket, key = self.split(location)
+        self.client.delete_object(Bucket=bucket, Key=key)
+
+    async def exists(self, location: str) -> bool:
+        bucket, key = self.split(location)
+        try:
+            await asyncio.to_thread(self.client.head_object, Bucket=bucket, Key=key)
+        except self.client_error:
+            return False
+        return True
+
+    async def download_url(self, location: str, filename: str) -> Optional[str]:
+        bucket, key = self.split(location)
+        return await asyncio.to_thread(
+            self.client.generate_presigned_url, "get_object",
+            Params={"Bucket": bucket, "Key": key, "ResponseContentDisposition": f'attachment; filename="{filename}"'},
+            ExpiresIn=app_config.RESULT_URL_TTL,
+        )
+
+    async def stream(self, location: str) -> AsyncIterator[bytes]:
+        bucket, key = self.split(location)
+        body = (await asyncio.to_thread(self.client.get_object, Bucket=bucket, Key=key))["Body"]
+        try:
+            while True:
+                chunk = await asyncio.to_thread(body.read, STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body.close()
+
+def write_atomically(path: Path, stream):
+    """Streams into a temporary file next to `path` and renames it, so readers never see a partial image."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            shutil.copyfileobj(stream, f, STREAM_CHUNK_SIZE)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+_storages: Dict[str, ResultStorage] = {}
+_storages_lock = threading.Lock()
+
+def get_storage(name: str) -> ResultStorage:
+    """The process-wide storage instance of a kind, built from the settings on first use."""
+    storage = _storages.get(name)
+    if storage is None:
+        with _storages_lock:
+            storage = _storages.get(name)
+            if storage is None:
+                if name == "local":
+                    storage = LocalStorage()
+                elif name == "filesystem":
+                    storage = FilesystemStorage(app_config.RESULT_STORAGE_PATH)
+                elif name == "redis":
+                    storage = RedisStorage()
+                elif name == "s3":
+                    storage = S3Storage(
+                        app_config.RESULT_S3_BUCKET, app_config.RESULT_S3_PREFIX,
+                        app_config.RESULT_S3_ENDPOINT_URL, app_config.RESULT_S3_REGION,
+                    )
+                else:
+                    raise ValueError(f"Unknown RESULT_STORAGE '{name}'.")
+                _storages[name] = storage
+    return storage
+
+def result_storage() -> ResultStorage:
+    """The storage workers save new images to (RESULT_STORAGE)."""
+    return get_storage(app_config.RESULT_STORAGE)
+
+def storage_for(location: str) -> ResultStorage:
+    """The storage holding an image, from its location."""
+    for name, prefix in (("filesystem", FilesystemStorage.prefix), ("redis", RedisStorage.prefix), ("s3", S3Storage.prefix)):
+        if location.startswith(prefix):
+            return get_storage(name)
+    return get_storage("local")
@@ -0,0 +1,243 @@
+# src/routing.py
+
+import logging
+import threading
+import time
+from typing import Optional, Set
+
+from .celery_app import celery_app
+from .config import app_config
+from .redis_client import get_async_redis, get_sync_redis
+from .scheduling import broker_keys, lane_queue, lane_queues, priority_queues
+
+logger = logging.getLogger(__name__)
+
+MODEL_QUEUE_PREFIX = "comfy.model."
+# Set of all model queues that have ever had a resident worker (without their lane suffixes).
+MODEL_QUEUES_KEY = "comfy:model-queues"
+# Per model: sorted set of worker hostnames that have it loaded, scored by last heartbeat.
+RESIDENT_KEY_PREFIX = "comfy:resident:"
+
+# Moves every message from list KEYS[i] to list KEYS[n + i] (n = #KEYS / 2), oldest
+# first, so they are consumed after what is already waiting there. Returns the count.
+_MOVE_SCRIPT = """
+local n = #KEYS / 2
+local moved = 0
+for i = 1, n do
+    while redis.call('RPOPLPUSH', KEYS[i], KEYS[n + i]) do
+        moved = moved + 1
+    end
+end
+return moved
+"""
+
+def model_queue(model: str) -> str:
+    return f"{MODEL_QUEUE_PREFIX}{model}"
+
+def resident_key(model: str) -> str:
+    return f"{RESIDENT_KEY_PREFIX}{model}"
+
+def resident_cutoff() -> float:
+    """Heartbeats older than this timestamp belong to workers that are gone."""
+    return time.time() - 3 * app_config.AFFINITY_HEARTBEAT_INTERVAL
+
+async def choose_queue(model: Optional[str], lane: Optional[str] = None) -> str:
+    """
+    API side: picks the queue for a task that needs `model`, in the given lane.
+
+    Tasks go to the model's own queue if a live worker has that model loaded,
+    unless that queue is backed up (AFFINITY_SPILLOVER_DEPTH tasks per resident
+    worker, over all lanes and priorities), in which case they spill over to the shared queue that
+    every worker consumes.
+    """
+    if not app_config.AFFINITY_ENABLED or not model:
+        return lane_queue(app_config.CELERY_DEFAULT_QUEUE, lane)
+
+    queue = model_queue(model)
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        pipe.zcount(resident_key(model), resident_cutoff(), "+inf")
+        for key in broker_keys(queue):
+            pipe.llen(key)
+        live_workers, *depths = await pipe.execute()
+
+    if live_workers == 0 or sum(depths) >= app_config.AFFINITY_SPILLOVER_DEPTH * live_workers:
+        return lane_queue(app_config.CELERY_DEFAULT_QUEUE, lane)
+    return lane_queue(queue, lane)
+
+def queue_depth(redis, queue: str) -> int:
+    """Tasks waiting in a queue, over all of its lanes and priorities."""
+    with redis.pipeline(transaction=False) as pipe:
+        for key in broker_keys(queue):
+            pipe.llen(key)
+        return sum(pipe.execute())
+
+def shared_keys(queue: str):
+    """Pairs each broker list of a model queue with the shared queue's list of the same lane and priority."""
+    shared = app_config.CELERY_DEFAULT_QUEUE
+    return [
+        (key, shared_key)
+        for lane_name, shared_lane in zip(lane_queues(queue), lane_queues(shared))
+        for key, shared_key in zip(priority_queues(lane_name), priority_queues(shared_lane))
+    ]
+
+def release_queue(redis, queue: str) -> int:
+    """Republishes the tasks waiting in a model queue to the shared queue, which every worker consumes."""
+    pairs = shared_keys(queue)
+    return redis.eval(_MOVE_SCRIPT, 2 * len(pairs), *[key for key, _ in pairs], *[shared_key for _, shared_key in pairs])
+
+class ModelAffinity:
+    """
+    Worker side: keeps this worker consuming the queue of the model it has loaded.
+
+    After each task the worker reports the model it used. When that changes, it
+    switches its model queue consumer and advertises itself as resident for the
+    new model. A heartbeat thread refreshes that advertisement and, while the
+    worker is idle, adopts model queues that are backed up. Tasks left in a model
+    queue that no live worker has resident are republished to the shared queue, both
+    when the last resident switches away and on every heartbeat (which also catches
+    tasks the API routed there just before the resident left).
+
+    Consumers and residency are per node (Celery hostname), but the resident model
+    is known per process. Affinity is therefore only active on nodes that run a
+    single worker process (threads or solo pool, or prefork with concurrency 1)
+    driving a single ComfyUI backend; elsewhere tasks go through the shared queue.
+    """
+
+    def __init__(self):
+        self.hostname: Optional[str] = None
+        self.resident_model: Optional[str] = None
+        self.adopted_queues: Set[str] = set()
+        # Tasks currently running in this worker process (more than one with a threads pool).
+        self.running_tasks = 0
+        self._lock = threading.Lock()
+        self._count_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.single_process = True
+
+    def configure_pool(self, pool_cls, concurrency: int):
+        """Called in the main worker process before it forks, with the pool it runs tasks in."""
+        pool_name = getattr(pool_cls, "__module__", None) or str(pool_cls)
+        self.single_process = "prefork" not in pool_name or concurrency == 1
+        if app_config.AFFINITY_ENABLED and not self.single_process:
+            logger.warning(f"Model affinity is off: this node runs {concurrency} worker processes (use -c 1 or a threads pool).")
+
+    @property
+    def active(self) -> bool:
+        return app_config.AFFINITY_ENABLED and self.single_process and app_config.comfyui_backend_count == 1
+
+    def start(self):
+        if not self.active or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="model-affinity", daemon=True)
+        self._thread.start()
+
+    @property
+    def busy(self) -> bool:
+        return self.running_tasks > 0
+
+    def task_started(self):
+        with self._count_lock:
+            self.running_tasks += 1
+
+    def task_finished(self):
+        with self._count_lock:
+            self.running_tasks -= 1
+
+    def note_resident(self, hostname: str, model: Optional[str]):
+        """Called after a task has run with `model`."""
+        if not self.active or not model:
+            return
+        with self._lock:
+            self.hostname = hostname
+            if model == self.resident_model:
+                return
+
+            previous, self.resident_model = self.resident_model, model
+            try:
+                for queue in self.adopted_queues | ({model_queue(previous)} if previous else set()):
+                    if queue != model_queue(model):
+                        self._cancel_consumer(queue, hostname)
+                self.adopted_queues.clear()
+                self._add_consumer(model_queue(model), hostname)
+
+                redis = get_sync_redis()
+                with redis.pipeline() as pipe:
+                    if previous:
+                        pipe.zrem(resident_key(previous), hostname)
+                    pipe.zadd(resident_key(model), {hostname: time.time()})
+                    pipe.sadd(MODEL_QUEUES_KEY, model_queue(model))
+                    pipe.execute()
+                logger.info(f"Worker {hostname} now has model '{model}' resident (was: '{previous}').")
+                if previous:
+                    self._release_if_orphaned(redis, model_queue(previous))
+            except Exception as e:
+                logger.warning(f"Could not update model affinity for '{model}': {e}")
+
+    def _add_consumer(self, queue: str, hostname: str):
+        for lane_name in lane_queues(queue):
+            celery_app.control.add_consumer(lane_name, destination=[hostname])
+
+    def _cancel_consumer(self, queue: str, hostname: str):
+        for lane_name in lane_queues(queue):
+            celery_app.control.cancel_consumer(lane_name, destination=[hostname])
+
+    def _release_if_orphaned(self, redis, queue: str):
+        model = queue[len(MODEL_QUEUE_PREFIX):]
+        if redis.zcount(resident_key(model), resident_cutoff(), "+inf"):
+            return
+        moved = release_queue(redis, queue)
+        if moved:
+            logger.info(f"Republished {moved} tasks from orphaned queue '{queue}' to the shared queue.")
+
+    def _run(self):
+        while True:
+            time.sleep(app_config.AFFINITY_HEARTBEAT_INTERVAL)
+            try:
+                with self._lock:
+                    self._heartbeat()
+                    self._release_orphans()
+                    if not self.busy:
+                        self._rebalance()
+            except Exception as e:
+                logger.warning(f"Model affinity heartbeat failed: {e}")
+
+    def _heartbeat(self):
+        if self.hostname and self.resident_model:
+            get_sync_redis().zadd(resident_key(self.resident_model), {self.hostname: time.time()})
+
+    def _release_orphans(self):
+        redis = get_sync_redis()
+        for queue in redis.smembers(MODEL_QUEUES_KEY):
+            if queue_depth(redis, queue):
+                self._release_if_orphaned(redis, queue)
+
+    def _rebalance(self):
+        """Adopts at most one backed-up or orphaned model queue while this worker has nothing to do."""
+        if not self.hostname:
+            return
+        redis = get_sync_redis()
+        own_queue = model_queue(self.resident_model) if self.resident_model else None
+        if (own_queue and queue_depth(redis, own_queue)) or queue_depth(redis, app_config.CELERY_DEFAULT_QUEUE):
+            return
+
+        for queue in list(self.adopted_queues):
+            if not queue_depth(redis, queue):
+                self._cancel_consumer(queue, self.hostname)
+                self.adopted_queues.discard(queue)
+
+        for queue in redis.smembers(MODEL_QUEUES_KEY):
+            if queue == own_queue or queue in self.adopted_queues:
+                continue
+            depth = queue_depth(redis, queue)
+            if not depth:
+                continue
+            model = queue[len(MODEL_QUEUE_PREFIX):]
+            live_workers = redis.zcount(resident_key(model), resident_cutoff(), "+inf")
+            if live_workers == 0 or depth >= app_config.AFFINITY_SPILLOVER_DEPTH * live_workers:
+                self._add_consumer(queue, self.hostname)
+                self.adopted_queues.add(queue)
+                logger.info(f"Worker {self.hostname} adopted queue '{queue}' ({depth} waiting, {live_workers} resident workers).")
+                return
+
+# Global instance, one per worker process.
+model_affinity = ModelAffinity()
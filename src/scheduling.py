@@ -0,0 +1,56 @@
+# src/scheduling.py
+
+from typing import Any, Dict, List, Optional
+
+from .config import app_config
+
+# Cheap jobs are sent to a separate lane: a "<queue>.preview" sibling of the queue they
+# would otherwise go to. Workers consume both lanes, and Kombu's Redis transport polls a
+# worker's queues round-robin, so neither lane can starve the other.
+PREVIEW_LANE = "preview"
+
+# Task priorities, 0 being the highest. Kombu's Redis transport keeps a separate list for
+# each priority of a queue: the queue's own name for 0 and "<queue>:<priority>" for the
+# others, and drains them in order (see the transport options in src/celery_app.py).
+PRIORITY_LEVELS = list(range(10))
+PRIORITY_SEPARATOR = ":"
+
+def estimate_cost(params: Dict[str, Any]) -> float:
+    """
+    A job's relative GPU cost in megapixel-steps, from its validated parameters:
+    width × height × steps × images, scaled by the model's cost factor and
+    reduced when First Block Cache (FBC_optimize) is on.
+    """
+    megapixels = float(params.get("width") or 1024) * float(params.get("height") or 1024) / 1_000_000
+    cost = megapixels * float(params.get("steps") or 1) * float(params.get("batch_size") or 1)
+    cost *= app_config.MODEL_COST_FACTORS.get(params.get("model"), 1.0)
+    if params.get("FBC_optimize"):
+        cost *= app_config.FBC_COST_FACTOR
+    return cost
+
+def choose_lane(params: Dict[str, Any]) -> Optional[str]:
+    """The lane for a job: PREVIEW_LANE for cheap jobs, None for the regular lane."""
+    if app_config.PREVIEW_LANE_ENABLED and estimate_cost(params) <= app_config.PREVIEW_MAX_COST:
+        return PREVIEW_LANE
+    return None
+
+def lane_queue(queue: str, lane: Optional[str]) -> str:
+    return f"{queue}.{lane}" if lane else queue
+
+def lane_queues(queue: str) -> List[str]:
+    """All lanes of a queue, each of which a worker consuming `queue` must also consume."""
+    if not app_config.PREVIEW_LANE_ENABLED:
+        return [queue]
+    return [queue, lane_queue(queue, PREVIEW_LANE)]
+
+def priority_queue(queue: str, priority: int) -> str:
+    """The broker list holding a queue's tasks of one priority."""
+    return f"{queue}{PRIORITY_SEPARATOR}{priority}" if priority else queue
+
+def priority_queues(queue: str) -> List[str]:
+    """The broker lists of a queue, from the highest priority to the lowest."""
+    return [priority_queue(queue, priority) for priority in PRIORITY_LEVELS]
+
+def broker_keys(queue: str) -> List[str]:
+    """Every broker list of a queue: all priorities of all of its lanes."""
+    return [key for lane_name in lane_queues(queue) for key in priority_queues(lane_name)]
@@ -0,0 +1,179 @@
+# src/task_store.py
+
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional, Set
+
+from celery import states
+
+from .celery_app import celery_app
+from .redis_client import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+# Celery's Redis result backend stores each task's state under this key and
+# publishes every state write on a channel of the same name.
+TASK_META_PREFIX = "celery-task-meta-"
+
+# Batches are stored as a JSON list of their task IDs under this prefix.
+BATCH_KEY_PREFIX = "comfy:batch:"
+
+# Sentinel pushed to listeners after the pub/sub connection was re-established,
+# telling them to re-read the stored state because they may have missed a message.
+RESYNC = object()
+
+def task_meta_key(task_id: str) -> str:
+    return f"{TASK_META_PREFIX}{task_id}"
+
+def decode_task_meta(task_id: str, raw: Optional[str]) -> Dict[str, Any]:
+    """Decodes a stored Celery task state. Unknown tasks are PENDING, as in Celery."""
+    if raw is None:
+        return {"task_id": task_id, "status": states.PENDING, "result": None}
+    return celery_app.backend.decode_result(raw)
+
+async def fetch_task_meta(task_id: str) -> Dict[str, Any]:
+    """Reads a task's state from the result backend without blocking the event loop."""
+    return decode_task_meta(task_id, await get_async_redis().get(task_meta_key(task_id)))
+
+async def task_exists(task_id: str) -> bool:
+    """True if the result backend holds any state for the task (unknown IDs read as PENDING)."""
+    return bool(await get_async_redis().exists(task_meta_key(task_id)))
+
+async def fetch_task_metas(task_ids: List[str]) -> List[Dict[str, Any]]:
+    """Reads many tasks' states with a single MGET round-trip."""
+    if not task_ids:
+        return []
+    raw_values = await get_async_redis().mget([task_meta_key(task_id) for task_id in task_ids])
+    return [decode_task_meta(task_id, raw) for task_id, raw in zip(task_ids, raw_values)]
+
+def batch_key(batch_id: str) -> str:
+    return f"{BATCH_KEY_PREFIX}{batch_id}"
+
+async def save_batch(batch_id: str, task_ids: List[str], tenant: Optional[str] = None):
+    """Stores a batch's task IDs and owning tenant for as long as Celery keeps the tasks' results."""
+    expires = celery_app.backend.expires
+    batch = {"task_ids": task_ids, "tenant": tenant}
+    await get_async_redis().set(batch_key(batch_id), json.dumps(batch), ex=int(expires) if expires else None)
+
+async def load_batch(batch_id: str) -> Optional[Dict[str, Any]]:
+    """The batch's {"task_ids", "tenant"}, or None if it is unknown or expired."""
+    raw = await get_async_redis().get(batch_key(batch_id))
+    if raw is None:
+        return None
+    batch = json.loads(raw)
+    # Batches stored before tenants were recorded hold just the list of task IDs.
+    return batch if isinstance(batch, dict) else {"task_ids": batch, "tenant": None}
+
+class TaskEventHub:
+    """
+    Fans task state changes out to any number of local listeners over a single
+    Redis pub/sub connection per API process.
+    """
+
+    def __init__(self):
+        self._listeners: Dict[str, Set[asyncio.Queue]] = {}
+        self._pubsub = None
+        self._reader: Optional[asyncio.Task] = None
+
+    async def subscribe(self, task_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        listeners = self._listeners.setdefault(task_id, set())
+        listeners.add(queue)
+        if len(listeners) == 1:
+            try:
+                await self._ensure_pubsub()
+                await self._pubsub.subscribe(task_meta_key(task_id))
+            except Exception:
+                await self.unsubscribe(task_id, queue)
+                raise
+        return queue
+
+    async def unsubscribe(self, task_id: str, queue: asyncio.Queue):
+        listeners = self._listeners.get(task_id)
+        if not listeners:
+            return
+        listeners.discard(queue)
+        if not listeners:
+            del self._listeners[task_id]
+            if self._pubsub is not None:
+                try:
+                    await self._pubsub.unsubscribe(task_meta_key(task_id))
+                except Exception as e:
+                    logger.warning(f"Could not unsubscribe from task {task_id}: {e}")
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+        self._pubsub = self._reader = None
+
+    async def _ensure_pubsub(self):
+        if self._pubsub is None:
+            self._pubsub = get_async_redis().pubsub(ignore_subscribe_messages=True)
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        while True:
+            try:
+                if not self._pubsub.subscribed:
+                    await asyncio.sleep(0.1)
+                    continue
+                message = await self._pubsub.get_message(timeout=1.0)
+                if message is None:
+                    continue
+                task_id = message["channel"][len(TASK_META_PREFIX):]
+                for queue in self._listeners.get(task_id, ()):
+                    queue.put_nowait(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Task event subscription failed, reconnecting: {e}")
+                await asyncio.sleep(1)
+                await self._resubscribe()
+
+    async def _resubscribe(self):
+        try:
+            await self._pubsub.aclose()
+        except Exception:
+            pass
+        self._pubsub = get_async_redis().pubsub(ignore_subscribe_messages=True)
+        try:
+            if self._listeners:
+                await self._pubsub.subscribe(*(task_meta_key(task_id) for task_id in self._listeners))
+        except Exception as e:
+            logger.warning(f"Could not resubscribe to task events: {e}")
+            return
+        for listeners in self._listeners.values():
+            for queue in listeners:
+                queue.put_nowait(RESYNC)
+
+# Global hub instance, one per API process.
+task_events = TaskEventHub()
+
+async def watch_task(task_id: str, keepalive: Optional[float] = None) -> AsyncIterator[Optional[Dict[str, Any]]]:
+    """
+    Yields the task's current state, then every state change until it reaches
+    a ready state (SUCCESS, FAILURE, REVOKED). If `keepalive` is set, `None` is
+    yielded whenever that many seconds pass without a change.
+    """
+    queue = await task_events.subscribe(task_id)
+    try:
+        # Subscribe before reading so that no transition can slip in between.
+        meta = await fetch_task_meta(task_id)
+        yield meta
+        while meta["status"] not in states.READY_STATES:
+            try:
+                payload = await asyncio.wait_for(queue.get(), keepalive)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if payload is RESYNC:
+                meta = await fetch_task_meta(task_id)
+            else:
+                meta = decode_task_meta(task_id, payload)
+            yield meta
+    finally:
+        await task_events.unsubscribe(task_id, queue)
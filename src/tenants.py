@@ -0,0 +1,190 @@
+# src/tenants.py
+
+import logging
+import math
+import threading
+import time
+import yaml
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from .config import app_config
+from .redis_client import get_async_redis, get_sync_redis
+from .scheduling import PRIORITY_LEVELS
+from .throughput import AdmissionRejected, completion_rate
+
+logger = logging.getLogger(__name__)
+
+# Per tenant: sorted set of its queued and running task IDs, scored by enqueue time
+# (start time once a worker picks the task up).
+INFLIGHT_KEY_PREFIX = "comfy:tenant-inflight:"
+
+# Atomically checks a tenant's concurrency cap and claims slots for new tasks.
+# KEYS[1] in-flight set; ARGV[1] now, ARGV[2] stale cutoff, ARGV[3] cap (0: none), ARGV[4...] task IDs.
+# Returns {claimed (0/1), tasks in flight before the claim}.
+_CLAIM_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+local count = redis.call('ZCARD', KEYS[1])
+local cap = tonumber(ARGV[3])
+if cap > 0 and count + #ARGV - 3 > cap then
+    return {0, count}
+end
+for i = 4, #ARGV do
+    redis.call('ZADD', KEYS[1], ARGV[1], ARGV[i])
+end
+return {1, count}
+"""
+
+class UnknownTenant(Exception):
+    """The request carries no API key, or one that no tenant owns."""
+
+class ConcurrencyLimitExceeded(AdmissionRejected):
+    """The tenant already has `max_concurrency` tasks queued or running."""
+
+class Tenant:
+    """One API client from tenants.yaml."""
+
+    __slots__ = ("name", "api_keys", "priority", "weight", "max_concurrency")
+
+    def __init__(self, name: str, info: Dict[str, Any]):
+        self.name = name
+        self.api_keys = [str(key) for key in info.get("api_keys") or []]
+        self.priority = min(max(int(info.get("priority", 0)), PRIORITY_LEVELS[0]), PRIORITY_LEVELS[-1])
+        self.weight = float(info.get("weight", 1))
+        self.max_concurrency = int(info.get("max_concurrency", 0))
+        if self.weight <= 0:
+            raise ValueError(f"Tenant '{name}' must have a positive weight.")
+
+def inflight_key(tenant_name: str) -> str:
+    return f"{INFLIGHT_KEY_PREFIX}{tenant_name}"
+
+def stale_cutoff() -> float:
+    """
+    Slots older than this timestamp belong to tasks that were lost (e.g. expired in
+    the broker). Slots are freed when their task finishes, so this only needs to
+    outlast the longest wait in the queue.
+    """
+    return time.time() - app_config.TENANT_INFLIGHT_TTL
+
+class TenantRegistry:
+    """
+    Holds the tenants from TENANTS_FILE and reloads them when the file changes,
+    checking at most every MANIFEST_RELOAD_INTERVAL seconds. Without the file,
+    the API is open and every request runs at the default priority.
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path
+        self._tenants: Dict[str, Tenant] = {}
+        self._by_key: Dict[str, Tenant] = {}
+        self._mtime: Optional[int] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _load(self, path: Path) -> Dict[str, Tenant]:
+        with open(path, 'r') as f:
+            manifest = yaml.safe_load(f) or {}
+        return {name: Tenant(name, info or {}) for name, info in (manifest.get("tenants") or {}).items()}
+
+    def current(self) -> Dict[str, Tenant]:
+        interval = app_config.MANIFEST_RELOAD_INTERVAL
+        if self._mtime is not None and (interval <= 0 or time.monotonic() - self._checked_at < interval):
+            return self._tenants
+
+        with self._lock:
+            self._checked_at = time.monotonic()
+            path = self.path or app_config.TENANTS_FILE
+            try:
+                mtime = path.stat().st_mtime_ns
+            except FileNotFoundError:
+                mtime = 0
+            if mtime == self._mtime:
+                return self._tenants
+            try:
+                tenants = self._load(path) if mtime else {}
+            except Exception as e:
+                if self._mtime is None:
+                    raise
+                self._mtime = mtime
+                logger.error(f"Could not reload {path}, keeping the previous tenants: {e}")
+                return self._tenants
+            self._tenants = tenants
+            self._by_key = {key: tenant for tenant in tenants.values() for key in tenant.api_keys}
+            self._mtime = mtime
+            logger.info(f"Loaded {len(tenants)} tenants from {path}.")
+            return self._tenants
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.current())
+
+    def identify(self, api_key: Optional[str]) -> Optional[Tenant]:
+        """The tenant owning `api_key`, or None if no tenants are configured."""
+        if not self.enabled:
+            return None
+        tenant = self._by_key.get(api_key) if api_key else None
+        if tenant is None:
+            raise UnknownTenant("A valid X-API-Key header is required.")
+        return tenant
+
+# Global registry instance, one per process.
+tenant_registry = TenantRegistry()
+
+async def assign_priority(tenant: Tenant) -> int:
+    """
+    Weighted fair share: a tenant with no more tasks in flight than its weight's share
+    of all in-flight tasks runs at its own priority. Beyond that, its new tasks are
+    demoted one level each time it doubles its share, so that lighter users of the
+    same or lower priority overtake them.
+    """
+    tenants = tenant_registry.current()
+    names = list(tenants)
+    cutoff = stale_cutoff()
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        for name in names:
+            pipe.zcount(inflight_key(name), cutoff, "+inf")
+        counts = dict(zip(names, await pipe.execute()))
+
+    total = sum(counts.values())
+    own = counts.get(tenant.name, 0)
+    if not own:
+        return tenant.priority
+    active_weight = sum(tenants[name].weight for name, count in counts.items() if count)
+    fair_share = total * tenant.weight / active_weight
+    if own <= fair_share:
+        return tenant.priority
+    return min(tenant.priority + math.ceil(math.log2(own / fair_share)), PRIORITY_LEVELS[-1])
+
+async def claim_slots(tenant: Tenant, task_ids: List[str]):
+    """
+    Counts new tasks against the tenant's concurrency cap, raising
+    ConcurrencyLimitExceeded (and claiming nothing) if they would exceed it.
+    """
+    claimed, count = await get_async_redis().eval(
+        _CLAIM_SCRIPT, 1, inflight_key(tenant.name), time.time(), stale_cutoff(), tenant.max_concurrency, *task_ids,
+    )
+    if not claimed:
+        excess = count + len(task_ids) - tenant.max_concurrency
+        rate = await completion_rate()
+        retry_after = max(1, math.ceil(excess / rate)) if rate else app_config.ADMISSION_DEFAULT_RETRY_AFTER
+        raise ConcurrencyLimitExceeded(
+            f"Tenant '{tenant.name}' has {count} tasks in flight (limit {tenant.max_concurrency}).", retry_after,
+        )
+
+async def release_slots(tenant_name: str, task_ids: List[str]):
+    """API side: frees the slots of tasks that were not enqueued after all, or were cancelled."""
+    await get_async_redis().zrem(inflight_key(tenant_name), *task_ids)
+
+def refresh_slot(tenant_name: str, task_id: str):
+    """Worker side: restarts a starting task's slot clock, so a long wait in the queue does not expire it."""
+    try:
+        get_sync_redis().zadd(inflight_key(tenant_name), {task_id: time.time()}, xx=True)
+    except Exception as e:
+        logger.warning(f"Could not refresh the slot of task {task_id} for tenant '{tenant_name}': {e}")
+
+def release_slot(tenant_name: str, task_id: str):
+    """Worker side: frees a finished task's slot. Never fails the task."""
+    try:
+        get_sync_redis().zrem(inflight_key(tenant_name), task_id)
+    except Exception as e:
+        logger.warning(f"Could not release the slot of task {task_id} for tenant '{tenant_name}': {e}")
@@ -0,0 +1,100 @@
+# src/throughput.py
+
+import logging
+import math
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from .config import app_config
+from .redis_client import get_async_redis, get_sync_redis
+from .routing import MODEL_QUEUES_KEY
+from .scheduling import PRIORITY_LEVELS, lane_queues, priority_queues
+
+logger = logging.getLogger(__name__)
+
+# Sorted set of recently finished task IDs, scored by completion time.
+COMPLETIONS_KEY = "comfy:completions"
+
+class AdmissionRejected(Exception):
+    """The system cannot take the request now; the client should retry after `retry_after` seconds."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def record_completion(task_id: str):
+    """Worker side: records that a task finished. Never fails the task."""
+    now = time.time()
+    try:
+        with get_sync_redis().pipeline() as pipe:
+            pipe.zadd(COMPLETIONS_KEY, {task_id: now})
+            pipe.zremrangebyscore(COMPLETIONS_KEY, "-inf", now - app_config.THROUGHPUT_WINDOW)
+            pipe.execute()
+    except Exception as e:
+        logger.warning(f"Could not record completion of task {task_id}: {e}")
+
+async def queue_depths() -> Dict[str, int]:
+    """
+    Tasks waiting in the broker, per queue: every lane of the shared queue and of
+    every model queue, each summed over its priorities.
+    """
+    redis = get_async_redis()
+    queues = [
+        lane_name
+        for queue in [app_config.CELERY_DEFAULT_QUEUE, *sorted(await redis.smembers(MODEL_QUEUES_KEY))]
+        for lane_name in lane_queues(queue)
+    ]
+    async with redis.pipeline(transaction=False) as pipe:
+        for queue in queues:
+            for key in priority_queues(queue):
+                pipe.llen(key)
+        lengths = await pipe.execute()
+    levels = len(PRIORITY_LEVELS)
+    return {queue: sum(lengths[i * levels:(i + 1) * levels]) for i, queue in enumerate(queues)}
+
+async def queue_depth() -> int:
+    """Tasks waiting in the broker, over all queues."""
+    return sum((await queue_depths()).values())
+
+async def completion_rate() -> Optional[float]:
+    """Tasks finished per second over the last THROUGHPUT_WINDOW seconds, or None without data."""
+    now = time.time()
+    completed = await get_async_redis().zcount(COMPLETIONS_KEY, now - app_config.THROUGHPUT_WINDOW, now)
+    return completed / app_config.THROUGHPUT_WINDOW if completed else None
+
+async def check_admission(new_tasks: int = 1, deadline: Optional[datetime] = None):
+    """
+    API side: raises AdmissionRejected if enqueuing `new_tasks` more tasks would push
+    the backlog past ADMISSION_MAX_QUEUE_DEPTH or its estimated drain time past
+    ADMISSION_MAX_DRAIN_SECONDS, or if the last of them would finish after `deadline`.
+    The Retry-After is how long the measured throughput needs to drain the excess.
+    """
+    max_depth = app_config.ADMISSION_MAX_QUEUE_DEPTH
+    max_drain = app_config.ADMISSION_MAX_DRAIN_SECONDS
+    if not max_depth and not max_drain and deadline is None:
+        return
+
+    depth = await queue_depth()
+    rate = await completion_rate()
+    backlog = depth + new_tasks
+
+    def retry_after(excess: float) -> int:
+        if not rate:
+            return app_config.ADMISSION_DEFAULT_RETRY_AFTER
+        return max(1, math.ceil(excess / rate))
+
+    if max_depth and backlog > max_depth:
+        raise AdmissionRejected(f"Queue is full ({depth} tasks waiting).", retry_after(backlog - max_depth))
+
+    if rate:
+        drain_seconds = backlog / rate
+        if max_drain and drain_seconds > max_drain:
+            raise AdmissionRejected(f"Queue is saturated (estimated wait {drain_seconds:.0f}s).", retry_after(backlog - max_drain * rate))
+        if deadline is not None:
+            remaining = (deadline - datetime.now(timezone.utc)).total_seconds()
+            if drain_seconds > remaining:
+                raise AdmissionRejected(
+                    f"Deadline cannot be met (estimated completion in {drain_seconds:.0f}s, {max(remaining, 0):.0f}s left).",
+                    retry_after(backlog - max(remaining, 0) * rate),
+                )
@@ -1,204 +1,299 @@
 # src/worker.py
 
-import os, sys, logging, json, uuid, aiohttp, asyncio, subprocess, time, urllib.request, urllib.error
-from pathlib import Path
-from typing import Dict, Any, Optional
-from celery.signals import worker_process_init
+import os, logging, json, asyncio, time
+from typing import Dict, Any, List, Optional, Tuple
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown, worker_shutdown
 from celery.app.task import Task
-import fcntl
+from celery.exceptions import Ignore, TimeLimitExceeded
 
+from . import estimates, metrics, result_cache, tenants, throughput
+from .backends import ComfyBackend, backend_pool
+from .cancellation import TaskCancelled, cancel_prompt, cancellation_watcher, is_cancelled
+from .capabilities import CapabilityPublisher, missing_capabilities
 from .config import app_config
-from .celery_app import celery_app
-from .workflow_utils import populate_workflow
+from .celery_app import GENERATE_TASK_NAME, celery_app
+from .comfy_client import ComfyUIClient, worker_loop
+from .progress import ProgressPublisher
+from .result_storage import result_storage
+from .routing import model_affinity
+from .scheduling import choose_lane, lane_queue
+from .workflow_utils import workflow_registry
 
-project_root = Path(__file__).resolve().parent.parent
-COMFYUI_ROOT = project_root / "ComfyUI"
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
-comfy_server_instance: Optional[subprocess.Popen] = None
-comfy_server_url: Optional[str] = None
-comfy_output_dir: Optional[Path] = None
+capability_publisher = CapabilityPublisher(
+    lambda: backend_pool.server_urls,
+    lambda: not any(backend.remote for backend in backend_pool.backends),
+)
 
-def set_pipe_size():
-    """
-    Increases the pipe buffer size for stdout/stderr on Linux.
-    This is called via preexec_fn and runs after fork() but before exec()
-    in the new child process. This helps prevent the ComfyUI process from
-    blocking if it generates a large amount of log output.
-    """
-    try:
-        # F_SETPIPE_SZ is available on Linux since kernel 2.6.35
-        # 134217728 bytes = 128 MB
-        # Set buffer size for stdout (file descriptor 1)
-        fcntl.fcntl(1, fcntl.F_SETPIPE_SZ, 134217728)
-        # And for stderr (file descriptor 2)
-        fcntl.fcntl(2, fcntl.F_SETPIPE_SZ, 134217728)
-    except (IOError, AttributeError, NameError) as e:
-        # If F_SETPIPE_SZ is not supported, it's not a critical error.
-        # uses os.write because standard logging might not be configured yet.
-        import os
-        os.write(2, f"Could not set pipe size: {e}\n".encode())
-    
-    # Also call the original function for process group management
-    if os.name == 'posix':
-        os.setpgrp()
-
-def ensure_comfy_server_is_running():
-    """
-    Ensures a ComfyUI server instance is running for this worker process.
-    If the process is dead, it restarts it.
-    """
-    global comfy_server_instance, comfy_server_url, comfy_output_dir
-    if comfy_server_instance and comfy_server_instance.poll() is None:
-        return
-    if comfy_server_instance:
-        logger.warning(f"ComfyUI process died with code {comfy_server_instance.poll()}. Restarting...")
-    
-    logger.info("Starting a fresh ComfyUI server instance on a random port...")
-    import socket
-    
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind(('', 0))
-        port = s.getsockname()[1]
-        
-    comfy_output_dir = COMFYUI_ROOT / "output"
-    comfy_output_dir.mkdir(exist_ok=True)
-    
-    command = [
-        sys.executable, "main.py", "--port", str(port),
-        "--output-directory", str(comfy_output_dir),
-        "--preview-method", "none", "--dont-print-server", "--disable-auto-launch"
-    ]
-    
-    proc = subprocess.Popen(command, cwd=str(COMFYUI_ROOT), preexec_fn=set_pipe_size)
-    url_to_check = f"http://127.0.0.1:{port}/object_info"
-    
-    for _ in range(app_config.COMFYUI_STARTUP_TIMEOUT):
-        if proc.poll() is not None:
-            raise RuntimeError("ComfyUI process terminated unexpectedly during startup.")
-        try:
-            with urllib.request.urlopen(url_to_check, timeout=1) as response:
-                if response.status == 200:
-                    logger.info(f"ComfyUI server is ready on port {port}.")
-                    comfy_server_instance, comfy_server_url = proc, f"http://127.0.0.1:{port}"
-                    return
-        except Exception:
-            time.sleep(1)
-            
-    proc.terminate()
-    proc.wait()
-    raise RuntimeError(f"ComfyUI server failed to start on port {port}.")
+# Celery's own hard time limit is set this much later than CELERY_TASK_TIME_LIMIT, so that
+# the worker's limit fires first and can take the prompt off its backend.
+TIME_LIMIT_GRACE = 30
+
+# Backoff schedule (seconds) for the /history fallback when no output arrived over the WebSocket.
+HISTORY_FALLBACK_DELAYS = (0.05, 0.1, 0.2, 0.4, 0.8)
 
 @worker_process_init.connect
 def on_worker_start(**kwargs):
-    """Pre-warms a ComfyUI instance when a Celery worker process starts."""
-    logger.info("Worker process started. Pre-warming ComfyUI server...")
+    """Pre-warms the ComfyUI backends when a Celery worker process starts."""
+    logger.info("Worker process started. Pre-warming ComfyUI backends...")
+    model_affinity.start()
+    cancellation_watcher.start(worker_loop.loop)
+    try:
+        result_storage()
+    except Exception as e:
+        logger.critical(f"FATAL: Result storage '{app_config.RESULT_STORAGE}' is unusable: {e}")
     try:
-        ensure_comfy_server_is_running()
+        backend_pool.ensure_started()
     except Exception as e:
         logger.critical(f"FATAL: Failed to start ComfyUI on worker init: {e}", exc_info=True)
+    capability_publisher.start()
+
+@worker_init.connect
+def on_worker_init(sender=None, **kwargs):
+    """
+    Pools that run tasks in the main process (threads, solo) never send
+    worker_process_init, so those workers pre-warm from here instead.
+    Model affinity learns here, before prefork children exist, how many there will be.
+    """
+    pool_cls = getattr(sender, "pool_cls", None)
+    if pool_cls is not None:
+        model_affinity.configure_pool(pool_cls, getattr(sender, "concurrency", 1))
+    if pool_cls is not None and "prefork" not in (getattr(pool_cls, "__module__", None) or str(pool_cls)):
+        on_worker_start()
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def on_worker_shutdown(**kwargs):
+    """Withdraws this worker from the capability registry and stops its ComfyUI servers."""
+    try:
+        capability_publisher.withdraw()
+    except Exception as e:
+        logger.warning(f"Could not withdraw worker capabilities: {e}")
+    backend_pool.stop()
 
 async def send_callback(url: str, data: Dict[str, Any]):
     """Sends a POST request to a callback URL."""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=data) as response:
-                response.raise_for_status()
-                logger.info(f"Successfully sent callback to {url}")
+        session = await worker_loop.get_session()
+        async with session.post(url, json=data) as response:
+            response.raise_for_status()
+            logger.info(f"Successfully sent callback to {url}")
     except Exception as e:
         logger.error(f"Exception occurred while sending callback to {url}: {e}", exc_info=True)
 
-async def execute_workflow_async(task: Task, populated_workflow: Dict[str, Any]) -> str:
-    """Executes a ComfyUI workflow via WebSocket and HTTP APIs."""
-    task_id = task.request.id
-    client_id = str(uuid.uuid4())
-    http_server_address = comfy_server_url.replace("http://", "")
-    ws_server_address = f"ws://{http_server_address}/ws?clientId={client_id}"
+async def fetch_history_images(task_id: str, client: ComfyUIClient, prompt_id: str) -> List[Dict[str, Any]]:
+    """
+    Fallback for when no `executed` message carried any images.
+    Polls /history with a short backoff, since ComfyUI may still be writing it.
+    """
+    history: Dict[str, Any] = {}
+    for delay in HISTORY_FALLBACK_DELAYS:
+        await asyncio.sleep(delay)
+        async with client.session.get(f"{client.base_url}/history/{prompt_id}") as history_resp:
+            history_resp.raise_for_status()
+            history = await history_resp.json()
 
-    async with aiohttp.ClientSession() as session:
-        prompt_data = {'prompt': populated_workflow, "client_id": client_id}
-        async with session.post(f"{comfy_server_url}/prompt", json=prompt_data) as response:
-            response.raise_for_status()
-            result = await response.json()
-            prompt_id = result.get("prompt_id")
-            if not prompt_id:
-                raise ValueError("API call to /prompt did not return a prompt_id.")
-            logger.info(f"[{task_id}] Workflow queued with prompt_id: {prompt_id}")
+        if prompt_id in history:
+            for _, node_output in history[prompt_id].get('outputs', {}).items():
+                if node_output.get("images"):
+                    return node_output["images"]
 
-        async with session.ws_connect(ws_server_address, timeout=app_config.CELERY_TASK_AIOHTTP_TIMEOUT) as ws:
-            logger.info(f"[{task_id}] WebSocket connected.")
-            task.update_state(state='PENDING', meta={'status': 'In queue'})
+    logger.error(f"[{task_id}] Critical: Output not found in history. History dump: {json.dumps(history)}")
+    return []
 
-            execution_complete = False
-            
-            async for msg in ws:
-                if isinstance(msg.data, str):
-                    message = json.loads(msg.data)
-                    msg_data = message.get('data', {})
-                    
-                    if 'prompt_id' in msg_data and msg_data['prompt_id'] == prompt_id:
-                        
-                        if message['type'] == 'progress':
-                            current_step = msg_data['value']
-                            total_steps = msg_data['max']
-                            task.update_state(
-                                state='PROGRESS',
-                                meta={
-                                    'current': current_step,
-                                    'total': total_steps,
-                                    'percent': round((current_step / total_steps) * 100, 2),
-                                    'step_name': 'Generating',
-                                }
-                            )
-                        
-                        elif message['type'] == 'executing' and msg_data.get('node') is None:
-                            logger.info(f"[{task_id}] Received completion signal.")
-                            execution_complete = True
-                            break
-
-            if not execution_complete:
-                raise TimeoutError(f"WebSocket connection closed before the completion signal was received for prompt {prompt_id}.")
-
-        logger.info(f"[{task_id}] Retrieving output from /history/{prompt_id}")
-        await asyncio.sleep(0.5) # Give a moment for history to be written
-        async with session.get(f"{comfy_server_url}/history/{prompt_id}") as history_resp:
-            history_resp.raise_for_status()
-            history = await history_resp.json()
-            
-            if prompt_id in history:
-                prompt_history = history[prompt_id]
-                for _, node_output in prompt_history.get('outputs', {}).items():
-                    if "images" in node_output and node_output["images"]:
-                        image = node_output["images"][0]
-                        return str(comfy_output_dir / image.get("subfolder", "") / image["filename"])
-            
-            logger.error(f"[{task_id}] Critical: Output not found in history. History dump: {json.dumps(history)}")
-            raise FileNotFoundError("Could not find output file in ComfyUI's history after execution.")
+async def execute_workflow_async(task: Task, task_id: str, workflow_id: str, params: Dict[str, Any], populated_workflow: Dict[str, Any], backend: ComfyBackend, deadline: float) -> List[str]:
+    """
+    Executes a ComfyUI workflow on `backend` over its persistent HTTP session and WebSocket.
+    Output images are collected from `executed` messages as they arrive, saved to
+    the result storage, and the locations of all of them are returned (one per image
+    of the latent batch). With OUTPUT_MODE="websocket", the images arrive as bytes
+    from the workflow's SaveImageWebsocket nodes instead, and go to the result
+    storage without touching the disk.
+    The execution time is fed into the duration estimates behind task ETAs.
+
+    The prompt must finish by `deadline` (a `time.monotonic()` value). Celery's
+    threads pool does not enforce time limits, so this does: an overdue prompt is
+    interrupted or removed from ComfyUI's queue and TimeLimitExceeded is raised.
+
+    This runs on the worker loop thread, where `task.request` is not populated,
+    so the task ID is passed in explicitly.
+    """
+    client = backend.client
+    images: List[Dict[str, Any]] = []
+    # (format, bytes) of the images received over the WebSocket, in websocket output mode.
+    output_images: List[Tuple[str, bytes]] = []
+    websocket_output = app_config.OUTPUT_MODE == "websocket"
+    save_nodes = set(workflow_registry.get(workflow_id).save_nodes) if websocket_output else set()
+
+    prompt_id = await client.queue_prompt(populated_workflow)
+    logger.info(f"[{task_id}] Workflow queued on {backend.name} with prompt_id: {prompt_id}")
+    cancellation_watcher.register(task_id, backend, prompt_id)
+    progress = ProgressPublisher(task, task_id)
+    progress.start()
+    try:
+        # The task may have been cancelled before the watcher knew its prompt.
+        if await asyncio.to_thread(is_cancelled, task_id):
+            await cancel_prompt(backend, prompt_id, task_id)
+        pending_meta = {'status': 'In queue', 'backend': backend.name}
+        try:
+            pending_meta['backend_position'] = await backend.queue_position(prompt_id)
+        except Exception as e:
+            logger.warning(f"[{task_id}] Could not read the queue of {backend.name}: {e}")
+        progress.publish('PENDING', pending_meta)
+
+        started_at: Optional[float] = None
+        while True:
+            try:
+                message = await asyncio.wait_for(client.next_message(prompt_id), max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                try:
+                    await cancel_prompt(backend, prompt_id, task_id)
+                except Exception as e:
+                    logger.warning(f"[{task_id}] Could not cancel overdue prompt {prompt_id} on {backend.name}: {e}")
+                if time.monotonic() >= deadline:
+                    raise TimeLimitExceeded(f"Task {task_id} exceeded CELERY_TASK_TIME_LIMIT ({app_config.CELERY_TASK_TIME_LIMIT}s).")
+                raise
+            msg_data = message.get('data', {})
+            if started_at is None and (message['type'] in ('execution_start', 'progress') or msg_data.get('node') is not None):
+                started_at = time.monotonic()
+
+            if message['type'] == 'progress':
+                current_step = msg_data['value']
+                total_steps = msg_data['max']
+                progress.publish('PROGRESS', {
+                    'current': current_step,
+                    'total': total_steps,
+                    'percent': round((current_step / total_steps) * 100, 2),
+                    'step_name': 'Generating',
+                })
+
+            elif message['type'] == 'executed':
+                images.extend((msg_data.get('output') or {}).get('images') or [])
+
+            elif message['type'] == 'output_image' and msg_data.get('node') in save_nodes:
+                output_images.append((msg_data['format'], msg_data['image']))
 
-@celery_app.task(name="generate_task", bind=True, acks_late=True, time_limit=app_config.CELERY_TASK_TIME_LIMIT)
-def generate_task(self: Task, workflow_id: str, params: Dict[str, Any], callback_url: Optional[str] = None) -> Dict[str, Any]:
-    """The main Celery task for image generation."""
+            elif message['type'] == 'execution_interrupted':
+                raise TaskCancelled(f"Task {task_id} was interrupted.")
+
+            elif message['type'] == 'execution_error':
+                raise RuntimeError(f"ComfyUI execution failed in node {msg_data.get('node_id')}: {msg_data.get('exception_message')}")
+
+            elif message['type'] == 'executing' and msg_data.get('node') is None:
+                logger.info(f"[{task_id}] Received completion signal.")
+                if started_at is not None:
+                    await asyncio.to_thread(estimates.record_duration, workflow_id, params, time.monotonic() - started_at)
+                break
+    finally:
+        cancellation_watcher.unregister(task_id)
+        client.unwatch(prompt_id)
+        await progress.close()
+
+    if websocket_output:
+        if not output_images:
+            raise FileNotFoundError("No image arrived over the WebSocket from the workflow's SaveImageWebsocket nodes.")
+        await asyncio.to_thread(record_output_metrics, False)
+        return [
+            await asyncio.to_thread(result_storage().save_bytes, task_id, f"{task_id}_{index:05d}.{image_format}", data)
+            for index, (image_format, data) in enumerate(output_images)
+        ]
+
+    used_fallback = not images
+    if used_fallback:
+        logger.warning(f"[{task_id}] No images in WebSocket output. Falling back to /history/{prompt_id}")
+        images = await fetch_history_images(task_id, client, prompt_id)
+    await asyncio.to_thread(record_output_metrics, used_fallback)
+
+    if not images:
+        raise FileNotFoundError("Could not find output file in ComfyUI's history after execution.")
+    paths = [await backend.image_path(image) for image in images]
+    return [await asyncio.to_thread(result_storage().save_file, task_id, path) for path in paths]
+
+def record_output_metrics(used_fallback: bool):
+    metrics.incr("outputs_total")
+    if used_fallback:
+        metrics.incr("outputs_history_fallback")
+
+@celery_app.task(name=GENERATE_TASK_NAME, bind=True, acks_late=True, time_limit=app_config.CELERY_TASK_TIME_LIMIT + TIME_LIMIT_GRACE)
+def generate_task(self: Task, workflow_id: str, params: Dict[str, Any], callback_url: Optional[str] = None, cache_key: Optional[str] = None, tenant: Optional[str] = None, reroutes: int = 0) -> Dict[str, Any]:
+    """
+    The main Celery task for image generation.
+    If `cache_key` is set, the result is recorded in the result cache under it.
+    The `tenant`'s concurrency slot is freed when the task finishes.
+    A task whose ComfyUI backend died under it is retried (on a healthy backend)
+    up to COMFYUI_BACKEND_RETRIES times before it fails. A cancelled task ends REVOKED.
+    A task this worker cannot run is sent back to the shared queue (`reroutes` counts how often).
+    """
     task_id = self.request.id
+    deadline = time.monotonic() + app_config.CELERY_TASK_TIME_LIMIT
+    if tenant:
+        tenants.refresh_slot(tenant, task_id)
+    model_affinity.task_started()
+    backend: Optional[ComfyBackend] = None
+    retrying = False
     try:
-        ensure_comfy_server_is_running()
-        workflow_path = project_root / "src" / "workflows" / f"{workflow_id}.json"
-        with open(workflow_path, "r") as f:
-            workflow_data = json.load(f)
-            
-        populated_workflow = populate_workflow(workflow_data, params)
-        file_path = asyncio.run(execute_workflow_async(self, populated_workflow))
+        if is_cancelled(task_id):
+            raise TaskCancelled(f"Task {task_id} was cancelled before it started.")
+        template = workflow_registry.get(workflow_id)
+        populated_workflow = template.populate(params)
+        if app_config.OUTPUT_MODE == "websocket":
+            populated_workflow = template.with_websocket_output(populated_workflow)
+        if capability_publisher.capabilities is not None:
+            missing = missing_capabilities(capability_publisher.capabilities, populated_workflow)
+            if missing:
+                if reroutes >= app_config.CAPABILITY_REROUTES:
+                    raise RuntimeError(f"Task {task_id} was rerouted {reroutes} times and its worker still lacks: {', '.join(missing)}.")
+                logger.warning(f"Task {task_id} needs {', '.join(missing)}, which this worker lacks; rerouting it to the shared queue.")
+                self.signature_from_request(
+                    kwargs=dict(self.request.kwargs, reroutes=reroutes + 1),
+                    queue=lane_queue(app_config.CELERY_DEFAULT_QUEUE, choose_lane(params)),
+                    countdown=1,
+                ).apply_async()
+                retrying = True
+                raise Ignore()
+        backend = backend_pool.acquire()
+        try:
+            file_paths = worker_loop.run(execute_workflow_async(self, task_id, workflow_id, params, populated_workflow, backend, deadline))
+        finally:
+            backend_pool.release(backend)
         
         if callback_url:
             base_url = app_config.PUBLIC_IP
-            file_name = os.path.basename(file_path)
-            download_url = f"{base_url}/results/{task_id}/{file_name}"
-            callback_data = {"task_id": task_id, "status": "SUCCESS", "result": {"download_url": download_url}}
-            asyncio.run(send_callback(callback_url, callback_data))
+            download_urls = [f"{base_url}/results/{task_id}/{os.path.basename(path)}" for path in file_paths]
+            callback_data = {"task_id": task_id, "status": "SUCCESS", "result": {"download_url": download_urls[0], "download_urls": download_urls}}
+            worker_loop.run(send_callback(callback_url, callback_data))
             
-        return {"file_path": file_path}
+        # `file_paths` holds result storage locations (plain paths for local storage).
+        # `file_path` (the first image) is kept for clients that predate batching.
+        result = {"file_path": file_paths[0], "file_paths": file_paths}
+        if cache_key:
+            result_cache.store(cache_key, result)
+        model_affinity.note_resident(self.request.hostname, params.get("model"))
+        return result
+    except TaskCancelled as e:
+        logger.info(f"Task {task_id} cancelled: {e}")
+        self.backend.mark_as_revoked(task_id, reason="cancelled", request=self.request)
+        if callback_url:
+            worker_loop.run(send_callback(callback_url, {"task_id": task_id, "status": "REVOKED", "result": str(e)}))
+        # The REVOKED state is already stored; Ignore keeps Celery from overwriting it.
+        raise Ignore()
+    except Ignore:
+        raise
     except Exception as e:
+        if backend is not None and not backend_pool.check(backend) and self.request.retries < app_config.COMFYUI_BACKEND_RETRIES:
+            logger.warning(f"Task {task_id} lost its ComfyUI backend {backend.name}; retrying: {e}")
+            retrying = True
+            raise self.retry(exc=e, countdown=1, max_retries=app_config.COMFYUI_BACKEND_RETRIES)
         logger.error(f"Task {task_id} failed: {e}", exc_info=True)
         if callback_url:
             callback_data = {"task_id": task_id, "status": "FAILURE", "result": str(e)}
-            asyncio.run(send_callback(callback_url, callback_data))
-        raise
\ No newline at end of file
+            worker_loop.run(send_callback(callback_url, callback_data))
+        raise
+    finally:
+        model_affinity.task_finished()
+        # A retried or rerouted task has not finished; it is recorded when it does.
+        if not retrying:
+            throughput.record_completion(task_id)
+            if tenant:
+                tenants.release_slot(tenant, task_id)
@@ -1,18 +1,146 @@
 # src/workflow_utils.py
 
-import copy
+import hashlib
+import json
 import logging
+import threading
+from pathlib import Path
 from typing import Any, Dict
 
 logger = logging.getLogger(__name__)
 
+# Saves images to ComfyUI's output directory, and its stand-in that sends them over the
+# WebSocket instead (a custom node shipped with ComfyUI, custom_nodes/websocket_image_save.py).
+SAVE_IMAGE_CLASS = "SaveImage"
+WEBSOCKET_SAVE_IMAGE_CLASS = "SaveImageWebsocket"
+
+WORKFLOWS_DIR = Path(__file__).parent / "workflows"
+
+class WorkflowTemplate:
+    """
+    A parsed ComfyUI workflow with a precomputed parameter-slot index.
+
+    The template is treated as immutable: `populate` never modifies `data`,
+    and the workflows it returns share every untouched node with it.
+    """
+
+    def __init__(self, workflow_id: str, workflow_data: Dict[str, Any], mtime_ns: int = 0, digest: str = ""):
+        self.workflow_id = workflow_id
+        self.data = workflow_data
+        self.mtime_ns = mtime_ns
+        self.digest = digest
+
+        # Map node titles to node IDs once, instead of on every request.
+        # `slots` only holds the titles whose node has an `inputs.value` field.
+        self.titles: Dict[str, str] = {}
+        for node_id, node_info in workflow_data.items():
+            title = node_info.get("_meta", {}).get("title")
+            if title:
+                self.titles[title] = node_id
+        # Node classes the workflow needs; a backend must provide all of them.
+        self.class_types = frozenset(node_info.get("class_type") for node_info in workflow_data.values() if node_info.get("class_type"))
+        self.save_nodes = [node_id for node_id, node_info in workflow_data.items() if node_info.get("class_type") == SAVE_IMAGE_CLASS]
+        self.slots: Dict[str, str] = {
+            title: node_id for title, node_id in self.titles.items()
+            if 'value' in workflow_data[node_id].get('inputs', {})
+        }
+
+    def populate(self, api_params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Returns a new workflow with `api_params` injected into the matching
+        `inputs.value` fields. Only the nodes that are written to are copied.
+        """
+        workflow = dict(self.data)
+
+        for param_name, param_value in api_params.items():
+            target_node_id = self.slots.get(param_name)
+            if target_node_id is None:
+                if param_name in self.titles:
+                    logger.warning(f"Could not set parameter '{param_name}'. Node '{self.titles[param_name]}' has no 'inputs.value' field.")
+                else:
+                    logger.warning(f"Parameter '{param_name}' from API request has no corresponding input node with that title in the workflow.")
+                continue
+
+            node = dict(workflow[target_node_id])
+            node['inputs'] = dict(node['inputs'])
+            node['inputs']['value'] = param_value
+            workflow[target_node_id] = node
+            logger.debug(f"Populated node '{target_node_id}' (title: '{param_name}') with value: {param_value}")
+
+        return workflow
+
+    def with_websocket_output(self, workflow: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Returns `workflow` (populated from this template) with its SaveImage nodes
+        swapped for SaveImageWebsocket, which sends the images to the client as
+        binary WebSocket frames instead of writing them to disk.
+        """
+        workflow = dict(workflow)
+        for node_id in self.save_nodes:
+            node = workflow[node_id]
+            workflow[node_id] = {
+                "inputs": {"images": node["inputs"]["images"]},
+                "class_type": WEBSOCKET_SAVE_IMAGE_CLASS,
+                "_meta": node.get("_meta", {}),
+            }
+        return workflow
+
+    def required_class_types(self, websocket_output: bool = False) -> frozenset:
+        """The node classes a backend must provide to run this workflow in the given output mode."""
+        if not websocket_output or not self.save_nodes:
+            return self.class_types
+        return (self.class_types - {SAVE_IMAGE_CLASS}) | {WEBSOCKET_SAVE_IMAGE_CLASS}
+
+class WorkflowRegistry:
+    """
+    Loads workflow templates from disk once per process and keeps them cached.
+    A template is re-read only when its file's mtime changes.
+    """
+
+    def __init__(self, workflows_dir: Path = WORKFLOWS_DIR):
+        self.workflows_dir = workflows_dir
+        self._templates: Dict[str, WorkflowTemplate] = {}
+        self._lock = threading.Lock()
+
+    def path_for(self, workflow_id: str) -> Path:
+        return self.workflows_dir / f"{workflow_id}.json"
+
+    def get(self, workflow_id: str) -> WorkflowTemplate:
+        """Returns the cached template, reloading it if the file has changed."""
+        path = self.path_for(workflow_id)
+        mtime_ns = path.stat().st_mtime_ns
+
+        template = self._templates.get(workflow_id)
+        if template is not None and template.mtime_ns == mtime_ns:
+            return template
+
+        with self._lock:
+            template = self._templates.get(workflow_id)
+            if template is not None and template.mtime_ns == mtime_ns:
+                return template
+
+            raw = path.read_bytes()
+            template = WorkflowTemplate(
+                workflow_id,
+                json.loads(raw),
+                mtime_ns=mtime_ns,
+                digest=hashlib.sha256(raw).hexdigest(),
+            )
+            self._templates[workflow_id] = template
+            logger.info(f"Loaded workflow template '{workflow_id}' ({len(template.data)} nodes, {len(template.slots)} parameter slots).")
+            return template
+
+# Global registry instance, one per process.
+workflow_registry = WorkflowRegistry()
+
 def populate_workflow(workflow_data: Dict[str, Any], api_params: Dict[str, Any]) -> Dict[str, Any]:
     """
     Injects parameters from the API into a ComfyUI workflow JSON object.
-    This is a lightweight, controlled, and independent function.
 
     It finds nodes in `workflow_data` by their title (`_meta.title`)
     and replaces the value in `inputs.value` with the value from `api_params`.
+    Prefer `workflow_registry.get(workflow_id).populate(...)`, which reuses
+    the parsed template and its slot index across calls.
 
     Args:
         workflow_data: The source workflow JSON loaded from a file.
@@ -23,27 +151,4 @@ def populate_workflow(workflow_data: Dict[str, Any], api_params: Dict[str, Any])
     Returns:
         A new workflow dictionary with the populated values.
     """
-    workflow = copy.deepcopy(workflow_data)
-
-    # Create a map from node titles to node IDs for efficient lookup
-    title_to_node_id_map: Dict[str, str] = {}
-    for node_id, node_info in workflow.items():
-        title = node_info.get("_meta", {}).get("title")
-        if title:
-            title_to_node_id_map[title] = node_id
-
-    # Iterate through the API parameters and populate the corresponding nodes
-    for param_name, param_value in api_params.items():
-        if param_name in title_to_node_id_map:
-            target_node_id = title_to_node_id_map[param_name]
-            
-            # Ensure the node has the expected structure before modifying it
-            if 'inputs' in workflow[target_node_id] and 'value' in workflow[target_node_id]['inputs']:
-                workflow[target_node_id]['inputs']['value'] = param_value
-                logger.debug(f"Populated node '{target_node_id}' (title: '{param_name}') with value: {param_value}")
-            else:
-                logger.warning(f"Could not set parameter '{param_name}'. Node '{target_node_id}' has no 'inputs.value' field.")
-        else:
-            logger.warning(f"Parameter '{param_name}' from API request has no corresponding input node with that title in the workflow.")
-
-    return workflow
\ No newline at end of file
+    return WorkflowTemplate("<inline>", workflow_data).populate(api_params)
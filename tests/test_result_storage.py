@@ -0,0 +1,36 @@
+# tests/test_result_storage.py
+
+import asyncio
+
+import pytest
+
+from src.result_storage import FilesystemStorage, storage_for
+
+def test_filesystem_storage_round_trip(tmp_path):
+    storage = FilesystemStorage(tmp_path / "results")
+    output = tmp_path / "output" / "task_00000_.png"
+    output.parent.mkdir()
+    output.write_bytes(b"png bytes")
+
+    location = storage.save_file("task", str(output))
+    assert location == "fs://task/task_00000_.png"
+    assert not output.exists()
+    assert asyncio.run(storage.exists(location))
+    with open(storage.local_path(location), "rb") as f:
+        assert f.read() == b"png bytes"
+
+    storage.delete(location)
+    assert not asyncio.run(storage.exists(location))
+    assert not (tmp_path / "results" / "task").exists()
+
+def test_filesystem_storage_saves_bytes(tmp_path):
+    storage = FilesystemStorage(tmp_path)
+    location = storage.save_bytes("task", "task_00000.png", b"png bytes")
+    with open(storage.local_path(location), "rb") as f:
+        assert f.read() == b"png bytes"
+    assert isinstance(storage_for(location), FilesystemStorage)
+
+def test_filesystem_storage_rejects_paths_outside_its_root(tmp_path):
+    storage = FilesystemStorage(tmp_path / "results")
+    with pytest.raises(ValueError):
+        storage.local_path("fs://../secret.png")